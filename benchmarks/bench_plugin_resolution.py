@@ -0,0 +1,45 @@
+"""
+Micro-benchmark of <plugin:...> URL resolution against the number of registered plugins
+
+Usage: python benchmarks/bench_plugin_resolution.py
+"""
+import os
+import pathlib
+import sys
+import tempfile
+import timeit
+import uuid
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+os.chdir(tempfile.mkdtemp())  # keep services.dat and friends out of the working tree
+
+from werkzeug.routing import Map  # noqa: E402
+
+from helpers import LocatePluginConvertor  # noqa: E402
+from service.manager import PluginService  # noqa: E402
+
+SIZES = (10, 100, 1_000, 10_000, 100_000)
+ROUNDS = 20_000
+
+
+def populate(count: int):
+    for i in range(len(PluginService.services), count):
+        PluginService(uuid.uuid4(), f'plugin-{i}', create=True)
+
+
+def main():
+    convertor = LocatePluginConvertor(Map())
+    print(f"{'plugins':>8} {'name/':>10} {'sid/':>10} {'bare sid':>10}  (us per lookup)")
+    for size in SIZES:
+        populate(size)
+        last = PluginService.locate(name=f'plugin-{size - 1}')
+        urls = (f'name/{last.name}', f'sid/{last.sid}', str(last.sid))
+        timings = [
+            timeit.timeit(lambda: convertor.to_python(url), number=ROUNDS) / ROUNDS * 1e6
+            for url in urls
+        ]
+        print(f"{size:>8} " + ' '.join(f'{t:>10.2f}' for t in timings))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Report payloads validated per second: the compiled validator against building the event by hand
+
+The hand-built path is what the report endpoint did before the validators: ad-hoc lookups, the dataclass
+constructor and the strongtyping-checked JavascriptError.
+Usage: python benchmarks/bench_validation.py [rounds]
+"""
+import datetime
+import json
+import os
+import pathlib
+import sys
+import tempfile
+import timeit
+import uuid
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+os.chdir(tempfile.mkdtemp())  # keep services.dat and friends out of the working tree
+
+from service.structures import ReportEvent, ReportLevel, JavascriptError  # noqa: E402
+from service.validation import validate  # noqa: E402
+
+SID = uuid.uuid4()
+PAYLOADS = {
+    'info only': {'level': 'info', 'description': 'started', 'info': 'ready in 12ms'},
+    'with error': {
+        'level': 'error', 'description': 'crashed', 'timestamp': 1_700_000_000.5, 'cid': str(uuid.uuid4()),
+        'error': {'name': 'TypeError', 'message': "x is undefined", 'stack': 'at main (index.js:1:1)'},
+    },
+    'error as string': {
+        'level': 'crash', 'description': 'crashed',
+        'error': json.dumps({'name': 'Error', 'message': 'boom', 'stack': None}),
+    },
+}
+
+
+def by_hand(data: dict) -> ReportEvent:
+    error = data.get('error')
+    if isinstance(error, str):
+        error = json.loads(error)
+    return ReportEvent(
+        cid=data.get('cid', uuid.uuid4()), sid=SID, level=ReportLevel[data.get('level')],
+        timestamp=data.get('timestamp', datetime.datetime.utcnow()), description=data.get('description'),
+        info=data.get('info'), error=JavascriptError(**error) if error else None, log=data.get('log'),
+    )
+
+
+def compiled(data: dict) -> ReportEvent:
+    report = dict(data, sid=SID)
+    if isinstance(report.get('error'), str):
+        report['error'] = json.loads(report['error'])
+    return validate(ReportEvent, report)
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    print(f"{'payload':>16} {'by hand':>12} {'compiled':>12}  (validations per second)")
+    for name, payload in PAYLOADS.items():
+        rates = [rounds / timeit.timeit(lambda: build(payload), number=rounds) for build in (by_hand, compiled)]
+        print(f"{name:>16} " + ' '.join(f'{rate:>12,.0f}' for rate in rates))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Memory per connection and connections per second of the websocket connection engines
+
+Connections are driven through an in-memory websocket, so the numbers only cover the server side state.
+Usage: python benchmarks/bench_ws_engines.py [connections]
+"""
+import asyncio
+import gc
+import os
+import pathlib
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+os.chdir(tempfile.mkdtemp())  # keep services.dat and friends out of the working tree
+
+from service.manager import PluginService, CLIENT_ENGINES  # noqa: E402
+
+
+class MemoryWebsocket:
+    def __init__(self, connected: asyncio.Event, expected: int, counter: list[int]):
+        self.inbox: asyncio.Queue = asyncio.Queue()
+        self.connected = connected
+        self.expected = expected
+        self.counter = counter
+
+    async def send(self, data):
+        self.counter[0] += 1
+        if self.counter[0] == self.expected:
+            self.connected.set()
+
+    async def receive(self):
+        return await self.inbox.get()
+
+
+async def run(engine: str, connections: int) -> tuple[float, float]:
+    PluginService.client_class = CLIENT_ENGINES[engine]
+    plugin = PluginService.register_with_name(f'bench-{engine}')
+    connected = asyncio.Event()
+    counter = [0]
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    tasks = [
+        asyncio.create_task(plugin.add_client().process(MemoryWebsocket(connected, connections, counter)))
+        for _ in range(connections)
+    ]
+    await connected.wait()
+    elapsed = time.perf_counter() - started
+    await asyncio.sleep(0)
+    gc.collect()
+    per_connection = (tracemalloc.get_traced_memory()[0] - before) / connections
+    tracemalloc.stop()
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return per_connection, connections / elapsed
+
+
+def main():
+    connections = int(sys.argv[1]) if len(sys.argv) > 1 else 5_000
+    print(f"{'engine':>8} {'bytes/conn':>12} {'conn/s':>12}  ({connections} connections)")
+    for engine in CLIENT_ENGINES:
+        per_connection, rate = asyncio.run(run(engine, connections))
+        print(f"{engine:>8} {per_connection:>12.0f} {rate:>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
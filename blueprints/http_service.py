@@ -1,4 +1,4 @@
-import datetime
+import re
 import uuid
 from http import HTTPStatus
 from json import JSONDecodeError
@@ -7,11 +7,20 @@ from quart import Blueprint, request, g
 from quart import json
 
 from oauth.funcs import login_required
+from service.admission import Admission
+from service.heartbeat import Heartbeat
+from service.ingest import IngestQueue
+from service.exceptions import InvalidPluginError
 from service.manager import PluginService
-from service.structures import ReportEvent, JavascriptError, ReportLevel, UpEventType
-from helpers import ResponseHelper
+from service.structures import ReportEvent, ReportLevel, UpEventType
+from service.validation import validate
+from helpers import PLUGIN_NAME_PATTERN, ResponseHelper, iter_json_items
 
 Bp = Blueprint('http:service', __name__, url_prefix='/api')
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+BATCH_DISPATCH_SIZE = 500  # reports of a batch handed to the handlers at once
+REPORT_KEYS = ('cid', 'level', 'timestamp', 'description', 'info', 'error', 'log')
 
 
 @Bp.route('/report/<plugin:plugin>', methods=['POST'])
@@ -24,49 +33,139 @@ async def send_report(plugin: PluginService):
             data_json = request.args
     except JSONDecodeError:
         return ResponseHelper.gen_kw(code=400, msg='Invalid data.', _status=HTTPStatus.BAD_REQUEST)
-    cid = data_json.get('cid', uuid.uuid4())
-    level = ReportLevel[data_json.get('level')]
-    timestamp = data_json.get('timestamp', datetime.datetime.utcnow())
-    description = data_json.get('description')
-    info = data_json.get('info')
-    error = data_json.get('error')
-    log = data_json.get('log')
-
     try:
-        if isinstance(error, str):
-            error = json.loads(error)
-        if not (isinstance(error, dict) or (info or error)):
-            raise TypeError
-    except (JSONDecodeError, TypeError):
-        return ResponseHelper.gen_kw(code=400, msg="'error' must be json serializable", _status=HTTPStatus.BAD_REQUEST)
-
-    if not ((level or timestamp or description) and (info or error)):
-        return ResponseHelper.gen_kw(code=400, msg="Missing required params", _status=HTTPStatus.BAD_REQUEST)
-
-    await plugin.raise_event(ReportEvent(
-        cid=cid,
-        sid=plugin.sid,
-        level=level, timestamp=timestamp, description=description,
-        info=info, error=JavascriptError(**error) if error else None, log=log
-    ))
+        report = build_report(plugin, data_json)
+    except ValueError as e:
+        return ResponseHelper.gen_kw(code=400, msg=str(e), _status=HTTPStatus.BAD_REQUEST)
+
+    if IngestQueue.enabled:
+        if not await IngestQueue.offer(plugin, (report,)):
+            return ResponseHelper.gen_kw(code=503, msg='Ingestion queue full', _status=HTTPStatus.SERVICE_UNAVAILABLE)
+        return ResponseHelper.gen_kw(msg='Report accepted', _status=HTTPStatus.ACCEPTED)
+    await plugin.raise_event(report)
 
     return ResponseHelper.gen_kw(msg='Report successfully')
 
 
+@Bp.route('/report/<plugin:plugin>/batch', methods=['POST'])
+async def send_reports(plugin: PluginService):
+    """
+    Report many events at once, the body is a JSON array of reports or one report per line (NDJSON).
+
+    The body is parsed as it is received, and the reports are handed to the handlers, or to the ingestion
+    queue when it is enabled, in batches of ``BATCH_DISPATCH_SIZE``. Invalid reports are skipped, the result
+    of each one is in ``results``. A body that turns out not to be UTF-8 stops the reading, the reports read
+    before are still accepted and ``msg`` says where it stopped.
+    """
+    results = []
+    batch: list[ReportEvent] = []
+    indexes: list[int] = []  # of the reports in the batch
+
+    async def dispatch():
+        if not IngestQueue.enabled:
+            await plugin.raise_events(batch)
+        elif not await IngestQueue.offer(plugin, batch):
+            for index in indexes:
+                results[index] = {'index': index, 'ok': False, 'msg': 'Ingestion queue full'}
+        batch.clear()
+        indexes.clear()
+
+    readable = True
+    try:
+        async for item, error in iter_json_items(request.body):
+            index = len(results)
+            if error is None:
+                try:
+                    if not isinstance(item, dict):
+                        raise ValueError('A report must be a JSON object')
+                    batch.append(build_report(plugin, item))
+                    indexes.append(index)
+                except ValueError as e:
+                    error = str(e)
+            if error is None:
+                results.append({'index': index, 'ok': True})
+            else:
+                results.append({'index': index, 'ok': False, 'msg': error})
+            if len(batch) >= BATCH_DISPATCH_SIZE:
+                await dispatch()
+    except UnicodeDecodeError:
+        # the reports before it may be dispatched already, they are accepted like the ones read so far
+        readable = False
+    if batch:
+        await dispatch()
+
+    accepted = sum(result['ok'] for result in results)
+    status = HTTPStatus.ACCEPTED if IngestQueue.enabled and accepted else HTTPStatus.OK
+    msg = None if readable else f'Body is not valid UTF-8 after report {len(results)}, the rest was not read'
+    return ResponseHelper.gen_kw(msg=msg, data={'count': len(results), 'accepted': accepted, 'results': results},
+                                 _status=status)
+
+
+def build_report(plugin: PluginService, data_json) -> ReportEvent:
+    """
+    Build the ReportEvent of a report request, other keys of the request are ignored
+    :raise ValueError: the report is invalid, its message says why
+    """
+    report = {key: data_json[key] for key in REPORT_KEYS if key in data_json}
+    report['sid'] = plugin.sid  # no cid unless the client sends one, a random one would only bloat the index
+    if isinstance(report.get('error'), str):
+        try:
+            report['error'] = json.loads(report['error'])
+        except JSONDecodeError:
+            raise ValueError("'error' must be json serializable")
+    report = validate(ReportEvent, report)
+    if not (report.info or report.error):
+        raise ValueError("Missing required params")
+    return report
+
+
 @Bp.route('/report/<plugin:plugin>', methods=['GET'])
 @login_required
 async def get_report(plugin: PluginService):
     user = g.user
     if not user:
-        ResponseHelper.gen_kw(code=401, _status=HTTPStatus.UNAUTHORIZED, msg='User not login')
+        return ResponseHelper.gen_kw(code=401, _status=HTTPStatus.UNAUTHORIZED, msg='User not login')
     if plugin.sid not in user.owned_services:
-        ResponseHelper.gen_kw(code=401, _status=HTTPStatus.UNAUTHORIZED, msg='User not owned this PluginService')
-    report_events = []
-    for event in plugin.events:
-        if event.type == UpEventType.report:
-            report_events.append(event)
-
-    return ResponseHelper.gen_kw(data=report_events)
+        return ResponseHelper.gen_kw(code=401, _status=HTTPStatus.UNAUTHORIZED, msg='User not owned this PluginService')
+
+    args = request.args
+    view = args.get('view', 'events')
+    if view == 'samples':
+        aggregate = (await plugin.all_crashes()).get(args.get('fingerprint', ''))
+        if aggregate is None:
+            return ResponseHelper.gen_kw(code=404, msg='Unknown fingerprint', _status=HTTPStatus.NOT_FOUND)
+        return ResponseHelper.gen_kw(data=aggregate.samples)
+    if view not in ('events', 'aggregates'):
+        return ResponseHelper.gen_kw(code=400, msg="'view' must be events, aggregates or samples",
+                                     _status=HTTPStatus.BAD_REQUEST)
+    try:
+        event_type = UpEventType(args.get('type', UpEventType.report))
+        level = ReportLevel[args['level']] if 'level' in args else None
+        since = float(args['since']) if 'since' in args else None
+        until = float(args['until']) if 'until' in args else None
+        limit = min(int(args.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        # an opaque string for the aggregates, parsed by Crashes.query
+        cursor = args.get('cursor') if view == 'aggregates' else int(args['cursor']) if 'cursor' in args else None
+    except (KeyError, ValueError):
+        return ResponseHelper.gen_kw(code=400, msg='Invalid query params', _status=HTTPStatus.BAD_REQUEST)
+    if limit <= 0:
+        return ResponseHelper.gen_kw(code=400, msg="'limit' must be positive", _status=HTTPStatus.BAD_REQUEST)
+
+    if view == 'aggregates':
+        try:
+            aggregates, cursor = (await plugin.all_crashes()).query(level=level, since=since, until=until,
+                                                                    limit=limit, cursor=cursor)
+        except ValueError:
+            return ResponseHelper.gen_kw(code=400, msg='Invalid query params', _status=HTTPStatus.BAD_REQUEST)
+        return ResponseHelper.gen_kw(data=[aggregate.summary() for aggregate in aggregates], cursor=cursor)
+
+    if PluginService.storage is not None:
+        await PluginService.flush()  # the events of the last flush window are queried too
+    report_events, cursor = await plugin.events.query(
+        event_type, level=level, cid=args.get('cid'), since=since, until=until, limit=limit, cursor=cursor
+    )
+
+    return ResponseHelper.gen_kw(data=report_events, cursor=cursor)
 
 
 @Bp.route('/plugin/name/<string:name>', methods=['PUT', 'POST'])
@@ -79,13 +178,70 @@ async def fetch(plugin: PluginService):
     return ResponseHelper.gen_kw(data=plugin.plugin_info)
 
 
+@Bp.route('/plugin/<plugin:plugin>/metrics', methods=['GET'])
+@login_required
+async def metrics(plugin: PluginService):
+    user = g.user
+    if not user:
+        return ResponseHelper.gen_kw(code=401, _status=HTTPStatus.UNAUTHORIZED, msg='User not login')
+    if plugin.sid not in user.owned_services:
+        return ResponseHelper.gen_kw(code=401, _status=HTTPStatus.UNAUTHORIZED, msg='User not owned this PluginService')
+    return ResponseHelper.gen_kw(data=plugin.metrics())
+
+
+@Bp.route('/plugin/<plugin:plugin>/name/<string:name>', methods=['PUT'])
+@login_required
+async def rename(plugin: PluginService, name: str):
+    user = g.user
+    if not user:
+        return ResponseHelper.gen_kw(code=401, _status=HTTPStatus.UNAUTHORIZED, msg='User not login')
+    if plugin.sid not in user.owned_services:
+        return ResponseHelper.gen_kw(code=401, _status=HTTPStatus.UNAUTHORIZED, msg='User not owned this PluginService')
+    # the plugin must stay reachable by /name/<name> URLs
+    if not re.fullmatch(PLUGIN_NAME_PATTERN, name):
+        return ResponseHelper.gen_kw(code=400, msg='Invalid name', _status=HTTPStatus.BAD_REQUEST)
+    try:
+        plugin.rename(name)
+    except InvalidPluginError as e:
+        return ResponseHelper.gen_kw(code=409, msg=str(e), _status=HTTPStatus.CONFLICT)
+    return ResponseHelper.gen_kw(data=plugin.plugin_info)
+
+
 @Bp.route('/broadcast/<plugin:plugin>', methods=['POST'])
 async def broadcast(plugin: PluginService):
-    await plugin.broadcast(str(request.args.get('message', None)))
-    return ResponseHelper.gen_kw(_status=HTTPStatus.NO_CONTENT)
+    """
+    Broadcast to every client, or to the ones matching the ``cid`` (repeatable) and ``version`` args
+    """
+    args = request.args
+    message = str(args.get('message', None))
+    if 'cid' not in args and 'version' not in args:
+        await plugin.broadcast(message)
+        return ResponseHelper.gen_kw(_status=HTTPStatus.NO_CONTENT)
+
+    try:
+        cids = [uuid.UUID(cid) for cid in args.getlist('cid')] if 'cid' in args else None
+        delivered = await plugin.send(message, cids, args.get('version'))
+    except ValueError:
+        return ResponseHelper.gen_kw(code=400, msg="Invalid 'cid' or 'version'", _status=HTTPStatus.BAD_REQUEST)
+    return ResponseHelper.gen_kw(data={'delivered': delivered})
+
+
+@Bp.route('/ingest/stats', methods=['GET'])
+@login_required
+async def ingest_stats():
+    return ResponseHelper.gen_kw(data=IngestQueue.stats())
+
+
+@Bp.route('/ws/stats', methods=['GET'])
+@login_required
+async def ws_stats():
+    return ResponseHelper.gen_kw(data={'admission': Admission.stats(), 'heartbeat': Heartbeat.stats()})
 
 
 @Bp.route('/_save', methods=['POST'])
 async def save():
-    PluginService.save()
+    if PluginService.storage is not None:
+        await PluginService.flush()
+    else:
+        await PluginService.checkpoint()
     return ResponseHelper.gen_kw(_status=HTTPStatus.OK)
@@ -1,51 +1,79 @@
-import uuid
+import asyncio
 
 from dataclasses import asdict
+from typing import Optional
+
 from quart import Blueprint, websocket
 
 from log import logger
+from service.admission import Admission
 from service.manager import PluginService
 from service.structures import ClientInfo
 
 Bp = Blueprint('ws:status', __name__, url_prefix='/ws')
 
 
-@Bp.websocket('/status/<plugin:plugin>')
-async def connection_plugin(plugin: PluginService):
-    client_info = ClientInfo(**asdict(plugin.plugin_info))
-    data = (await websocket.receive_json())
+async def defer(retry_after: float):
+    # accepted first, a close frame cannot be sent otherwise
+    await websocket.accept()
+    await websocket.close(Admission.close_code, Admission.reason(retry_after))
+
+
+async def receive_client_info(defaults: dict) -> Optional[ClientInfo]:
+    """
+    Read the ClientInfo of the handshake, the websocket is closed if it is invalid
+    """
+    try:
+        data = await asyncio.wait_for(websocket.receive_json(), Admission.handshake_timeout)
+    except asyncio.TimeoutError:
+        await websocket.close(1008, 'Handshake timeout')
+        return None
     if isinstance(data, dict):
-        plugin_default_info = asdict(client_info)
-        data.update(plugin_default_info)
         try:
-            client_info = ClientInfo(**data)
-        except TypeError as e:
-            logger.debug("Bad ClientInfo")
-            await websocket.close(1008, 'Bad ClientInfo')
+            return ClientInfo(**(defaults | data))
+        except (TypeError, ValueError) as e:
+            logger.debug("Bad ClientInfo: {e}", e=e)
+    await websocket.close(1008, 'Bad ClientInfo')
+    return None
+
+
+@Bp.websocket('/status/<plugin:plugin>')
+async def connection_plugin(plugin: PluginService):
+    retry_after = Admission.enter()
+    if retry_after is not None:
+        return await defer(retry_after)
+    try:
+        retry_after = Admission.admit(plugin.sid)
+        if retry_after is not None:
+            return await defer(retry_after)
+        client_info = await receive_client_info(asdict(ClientInfo(**asdict(plugin.plugin_info))))
+        if client_info is None:
             return
-    else:
-        await websocket.close(1008, 'Bad ClientInfo')
-        return
+        client = plugin.add_client(client_info=client_info)
+    finally:
+        Admission.leave()
 
-    await plugin.add_client(client_info=client_info).process(websocket)
+    await client.process(websocket)
 
 
 @Bp.websocket('/status')
 async def connection():
-    client_info = ClientInfo(sid=uuid.UUID('00000000-0000-0000-0000-000000000000'))
-    data = (await websocket.receive_json())
-    if isinstance(data, dict):
-        try:
-            client_info = ClientInfo(**data)
-        except TypeError as e:
-            logger.debug("Bad ClientInfo: {e}", e=e)
-            await websocket.close(1008, 'Bad ClientInfo')
+    retry_after = Admission.enter()
+    if retry_after is not None:
+        return await defer(retry_after)
+    try:
+        client_info = await receive_client_info({})
+        if client_info is None:
             return
-    else:
-        await websocket.close(1008, 'Bad ClientInfo')
-        return
 
-    plugin = PluginService(sid=client_info.sid, name=client_info.name)
-    client_info.sid = plugin.sid  # sync sid
+        plugin = PluginService.get(sid=client_info.sid, name=client_info.name)
+        client_info.sid = plugin.sid  # sync sid
+
+        retry_after = Admission.admit(plugin.sid)
+        if retry_after is not None:
+            return await defer(retry_after)
+        client = plugin.add_client(client_info=client_info)
+    finally:
+        Admission.leave()
 
-    await plugin.add_client().process(websocket)
+    await client.process(websocket)
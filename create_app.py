@@ -7,7 +7,15 @@ from oauth import init_oauth
 
 # noinspection PyUnresolvedReferences
 from quart import Quart
-from service.manager import PluginService
+from service.bus import BUSES
+from service.eventstore import EventStore
+from service.manager import PluginService, CLIENT_ENGINES
+from service.admission import Admission
+from service.heartbeat import Heartbeat
+from service.ingest import IngestQueue
+from service.reportlog import ReportLog
+from oauth.structures import OAuthStorage
+from storage import SqliteStorage
 from helpers import LocatePluginTypeConvertor, LocatePluginConvertor, internal_error_handler
 from blueprints.http_service import Bp as HTTPService
 from blueprints.legacy import Bp as LegacyAPI
@@ -19,7 +27,24 @@ placeholder()
 def create_app():
     app = Quart(__name__, instance_path=str(pathlib.Path('./instance').absolute()))
     app.config.from_prefixed_env()
+    PluginService.client_class = CLIENT_ENGINES[app.config.get('CLIENT_ENGINE', 'tasks')]
+    PluginService.bus = BUSES[app.config.get('BUS', 'local')]()
+    app.while_serving(PluginService.bus_connection)
+    EventStore.max_events = app.config.get('MAX_EVENTS', EventStore.max_events)
+    Heartbeat.ping_interval = app.config.get('PING_INTERVAL', Heartbeat.ping_interval)
+    Heartbeat.timeout = app.config.get('PING_TIMEOUT', Heartbeat.timeout)
+    app.while_serving(Heartbeat.scheduler)
+    Admission.configure(app.config.get('ADMISSION_RATE'), app.config.get('ADMISSION_BURST'),
+                        app.config.get('ADMISSION_PLUGIN_RATE'), app.config.get('ADMISSION_PLUGIN_BURST'),
+                        app.config.get('ADMISSION_MAX_HANDSHAKES'))
+    IngestQueue.configure(app.config.get('INGEST_QUEUE'), app.config.get('INGEST_QUEUE_SIZE'),
+                          app.config.get('INGEST_DRAINERS'), app.config.get('INGEST_BATCH_SIZE'),
+                          app.config.get('INGEST_DURABLE'))
+    app.before_serving(IngestQueue.start)
+    app.after_serving(IngestQueue.stop)  # drained before the services are saved and the logs closed
     app.after_serving(PluginService.save)
+    app.while_serving(PluginService.compaction)
+    app.after_serving(ReportLog.close_all)
     # noinspection SpellCheckingInspection
     app.url_map.converters['ltype'] = LocatePluginTypeConvertor
     app.url_map.converters['plugin'] = LocatePluginConvertor
@@ -31,4 +56,10 @@ def create_app():
 
     init_oauth(app)
 
+    if app.config.get('STORAGE', 'pickle') == 'sqlite':
+        storage = SqliteStorage()
+        PluginService.use_storage(storage)
+        OAuthStorage.use_storage(storage)
+        app.after_serving(storage.close)  # after the services and OAuth data are saved
+
     return app
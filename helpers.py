@@ -1,7 +1,9 @@
 import functools
+import re
 import uuid
 from http import HTTPStatus
-from typing import Optional, Any, AnyStr, Iterable
+from json import JSONDecodeError, JSONDecoder
+from typing import Optional, Any, AnyStr, AsyncIterable, AsyncIterator, Iterable
 
 from quart import json, Response
 from quart.wrappers.response import ResponseBody
@@ -26,8 +28,7 @@ class ResponseHelper:
 
     @classmethod
     def gen_json_str(cls, dictionary: dict):
-        template_dict = cls.gen_default()
-        template_dict.update(dictionary)
+        template_dict = cls.gen_default() | dictionary
         return json.dumps(template_dict, ensure_ascii=False)
 
     @classmethod
@@ -51,10 +52,13 @@ class LocatePluginTypeConvertor(BaseConverter):
         return str(value)
 
 
+PLUGIN_NAME_PATTERN = r"[a-zA-Z][a-zA-Z0-9\-]{0,30}"
+
+
 class LocatePluginConvertor(BaseConverter):
     regex = (
         r"(sid\/([A-Fa-f0-9]{8}-[A-Fa-f0-9]{4}-[A-Fa-f0-9]{4}-[A-Fa-f0-9]{4}-[A-Fa-f0-9]{12}))|"
-        r"(name\/[a-zA-Z][a-zA-Z0-9\-]{0,30})|"
+        rf"(name\/{PLUGIN_NAME_PATTERN})|"
         r"([A-Fa-f0-9]{8}-[A-Fa-f0-9]{4}-[A-Fa-f0-9]{4}-[A-Fa-f0-9]{4}-[A-Fa-f0-9]{12})"
     )
 
@@ -62,14 +66,16 @@ class LocatePluginConvertor(BaseConverter):
         sid: Optional[uuid.UUID] = None
         name: Optional[str] = None
         if value.startswith("sid/"):
-            sid = uuid.UUID(value.removeprefix('sid/'))
+            sid = uuid.UUID(value[4:])
         elif value.startswith('name/'):
-            name = str(value.removeprefix('name/'))
-        elif all(map(lambda s: s.lower() in 'abcdef0123456789-', value)):
-            sid = uuid.UUID(value)
+            name = value[5:]
         else:
-            raise ValidationError()
-        return PluginService(sid, name)
+            # the regex only lets a bare sid through here
+            try:
+                sid = uuid.UUID(value)
+            except ValueError:
+                raise ValidationError()
+        return PluginService.get(sid, name)
 
     def to_url(self, value: PluginService) -> str:
         if isinstance(value, uuid.UUID):
@@ -79,6 +85,132 @@ class LocatePluginConvertor(BaseConverter):
         raise ValidationError()
 
 
+_decoder = JSONDecoder()
+# the tokens that delimit the items of a JSON array: strings (skipped whole), brackets and commas, a lone quote
+# is a string going on in the next chunk
+_ARRAY_TOKENS = re.compile(r'"(?:[^"\\]++|\\.)*+"|[\[\]{},]|"')
+
+
+def _array_item_end(buffer: str, scan: int, depth: int) -> int | tuple[int, int]:
+    """
+    Find the ',' or ']' ending an array item, from ``scan`` at the nesting ``depth`` of the item
+    :return: its position, or (where to scan on, depth there) when the item goes on in the next chunk
+    """
+    while match := _ARRAY_TOKENS.search(buffer, scan):
+        token = match.group()
+        if token == '"':
+            return match.start(), depth  # scanned again once the string is complete
+        scan = match.end()
+        if token == '[' or token == '{':
+            depth += 1
+        elif depth and (token == ']' or token == '}'):
+            depth -= 1
+        elif not depth and (token == ',' or token == ']'):
+            return match.start()
+    return len(buffer), depth
+
+
+async def iter_json_items(chunks: AsyncIterable[bytes]) -> AsyncIterator[tuple[Any, Optional[str]]]:
+    """
+    Parse a JSON array or newline-delimited JSON body as its chunks arrive
+
+    An array item that cannot be parsed is delimited at its top-level ',' or ']', reported and skipped, the next
+    ones are still read. Only the item being received is buffered.
+    :raise UnicodeDecodeError: the body is not UTF-8, after the items before the invalid bytes
+    :return: (item, None) for each item, or (None, error message) for an item that is not valid JSON
+    """
+    pending = b''
+    buffer = ''
+    array = None
+    start = scan = depth = 0  # of the array item being received: where it starts, where to scan on, nesting
+    after_comma = closed = trailing = False
+    undecodable = None
+    async for chunk in chunks:
+        # a chunk may end within a multibyte character
+        pending += chunk
+        try:
+            buffer += pending.decode('u8')
+            pending = b''
+        except UnicodeDecodeError as e:
+            buffer += pending[:e.start].decode('u8')
+            pending = pending[e.start:]
+            if e.reason != 'unexpected end of data':
+                undecodable = e  # raised once the items before it are parsed
+        if array is None and buffer.strip():
+            stripped = buffer.lstrip()
+            array = stripped[0] == '['
+            buffer = stripped[1:] if array else stripped
+        if array is None:
+            pass
+        elif closed:
+            trailing = trailing or bool(buffer.strip())
+            buffer = ''
+        elif array:
+            while True:
+                position = start
+                while position < len(buffer) and buffer[position] in ' \t\r\n':
+                    position += 1
+                if position == len(buffer):
+                    break
+                end = None  # of the item, at its ',' or ']'
+                if buffer[position] in ',]':
+                    end = position
+                    if after_comma or buffer[position] == ',':
+                        yield None, 'Invalid JSON: missing array item'
+                else:
+                    try:
+                        item, end = _decoder.raw_decode(buffer, position)
+                    except JSONDecodeError:
+                        end = None
+                    else:
+                        while end < len(buffer) and buffer[end] in ' \t\r\n':
+                            end += 1
+                        if end == len(buffer):
+                            break  # its ',' or ']', or the rest of a number, is in the next chunk
+                        if buffer[end] in ',]':
+                            yield item, None
+                        else:
+                            end = None
+                if end is None:
+                    # invalid or incomplete, delimit the item to skip it
+                    end = _array_item_end(buffer, scan if scan > position else position, depth)
+                    if isinstance(end, tuple):
+                        scan, depth = end
+                        break
+                    yield _parse_line(buffer[position:end])
+                closed = buffer[end] == ']'
+                after_comma = not closed
+                start = scan = end + 1
+                depth = 0
+                if closed:
+                    trailing = bool(buffer[start:].strip())
+                    break
+            buffer = '' if closed else buffer[start:]
+            scan -= start
+            start = 0
+        else:
+            *lines, buffer = buffer.split('\n')
+            for line in lines:
+                if line.strip():
+                    yield _parse_line(line)
+        if undecodable is not None:
+            raise undecodable
+    if array:
+        if not closed:
+            yield None, 'Unterminated JSON array'
+        elif trailing:
+            yield None, 'Invalid JSON: data after the array'
+    elif buffer.strip():
+        yield _parse_line(buffer)
+
+
+def _parse_line(line: str) -> tuple[Any, Optional[str]]:
+    try:
+        return json.loads(line), None
+    except JSONDecodeError as e:
+        return None, f'Invalid JSON: {e}'
+
+
 def internal_error_handler(e: Exception):
     if isinstance(e, BasePluginError):
         return ResponseHelper.gen_kw(code=400, msg=str(e), _status=HTTPStatus.BAD_REQUEST)
@@ -1,13 +1,72 @@
+import collections
+import time
 from functools import wraps
-from quart import g, request, url_for, redirect, session
+from http import HTTPStatus
+from typing import Optional
+
+from quart import g, request, url_for, redirect, session, current_app
 from .oauth import authorization
+from .structures import OAuthStorage, Token, User
+
+
+class BearerCache:
+    """
+    Small LRU of recently validated access tokens, so polling clients skip the token checks
+    """
+    size = 1024
+    ttl = 30  # seconds before an entry is validated again
+    entries: collections.OrderedDict[str, tuple[float, Token]] = collections.OrderedDict()
+
+    @classmethod
+    def get(cls, access_token: str) -> Optional[Token]:
+        entry = cls.entries.get(access_token)
+        if entry is None:
+            return None
+        valid_until, token = entry
+        if valid_until < time.monotonic() or token.revoked:
+            del cls.entries[access_token]
+            return None
+        cls.entries.move_to_end(access_token)
+        return token
+
+    @classmethod
+    def put(cls, access_token: str, token: Token):
+        cls.entries[access_token] = (time.monotonic() + cls.ttl, token)
+        cls.entries.move_to_end(access_token)
+        if len(cls.entries) > cls.size:
+            cls.entries.popitem(last=False)
+
+
+async def bearer_user(authorization_header: str) -> Optional[User]:
+    scheme, _, access_token = authorization_header.partition(' ')
+    if scheme.lower() != 'bearer' or not access_token:
+        return None
+    token = BearerCache.get(access_token)
+    if token is None:
+        token = OAuthStorage.find_token(access_token)
+        # maybe issued by another worker since the last reload
+        if token is None and await OAuthStorage.refresh(OAuthStorage.miss_refresh_interval):
+            token = OAuthStorage.find_token(access_token)
+        if token is None or token.is_revoked() or token.is_expired():
+            return None
+        BearerCache.put(access_token, token)
+    elif token.is_expired():
+        return None
+    # the token holds its own copy of the user since it was unpickled, the indexed one is current
+    return OAuthStorage.users.get(token.client.user.uid)
 
 
 def login_required(f):
     @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if g.user is None:
+    async def decorated_function(*args, **kwargs):
+        authorization_header = request.headers.get('Authorization', '')
+        # other schemes (e.g. Basic added by a proxy) are not ours, the session decides then
+        if authorization_header.partition(' ')[0].lower() == 'bearer':
+            g.user = await bearer_user(authorization_header)
+            if g.user is None:
+                return 'Invalid token', HTTPStatus.UNAUTHORIZED
+        elif g.user is None:
             return redirect(url_for('http:auth.login', next=request.url))
-        return f(*args, **kwargs)
+        return await current_app.ensure_async(f)(*args, **kwargs)
 
     return decorated_function
@@ -2,7 +2,9 @@ import uuid
 from datetime import datetime, timedelta
 from typing import Optional
 
-from quart import Quart, g, session
+from quart import Quart, session
+from quart.ctx import _AppCtxGlobals
+from quart.sessions import SecureCookieSessionInterface
 from oauth.structures import OAuthStorage, Client, Token, User
 from authlib.integrations.flask_oauth2 import AuthorizationServer
 
@@ -10,21 +12,58 @@ from authlib.integrations.flask_oauth2 import AuthorizationServer
 def current_user():
     if 'id' in session:
         uid = session['id']
-        return OAuthStorage.users[uuid.UUID(uid)]
+        return OAuthStorage.users.get(uuid.UUID(uid))  # None until a user of another worker is reloaded
     return None
 
 
+class LazyUserGlobals(_AppCtxGlobals):
+    """
+    ``g`` resolving ``g.user`` from the session the first time it is read
+    """
+
+    def __getattr__(self, name: str):
+        if name == 'user':
+            self.user = current_user()
+            return self.user
+        raise AttributeError(name)
+
+
+class IngestionSessionInterface(SecureCookieSessionInterface):
+    """
+    Cookie sessions that are not decoded at all on the ingestion routes
+    """
+    sessionless: list[tuple[Optional[set[str]], str]] = [
+        ({'POST'}, '/api/report/'),
+        ({'POST'}, '/api/broadcast/'),
+        (None, '/ws/'),
+    ]  # (methods, None for all; path prefix)
+
+    async def open_session(self, app: Quart, request):
+        path = request.path
+        for methods, prefix in self.sessionless:
+            if path.startswith(prefix) and (methods is None or request.method in methods):
+                return self.session_class()
+        return await super().open_session(app, request)
+
+
 def query_client(client_id: uuid.UUID | str | int):
-    return OAuthStorage.clients.pop()
+    try:
+        return OAuthStorage.clients.get(uuid.UUID(str(client_id)))
+    except ValueError:
+        return None
 
 
 def save_token(token_data, request):
     token = Token(
+        tid=uuid.uuid4(),
+        access_token=token_data['access_token'],
+        refresh_token=token_data.get('refresh_token', ''),
         client=request.client,
-        **token_data
+        scopes=token_data.get('scope', '').split(),
+        expires_at=datetime.utcnow() + timedelta(seconds=token_data.get('expires_in', 0)),
+        token_type=token_data.get('token_type', 'Bearer')
     )
     token.add()
-    OAuthStorage.save()
 
 
 authorization = AuthorizationServer(
@@ -42,10 +81,10 @@ def init_oauth(app: Quart):
     app.register_blueprint(OAuthAPIBlueprint)
 
     app.before_serving(OAuthStorage.load)
-    app.after_serving(OAuthStorage.save)
+    app.after_serving(OAuthStorage.close)
+    app.while_serving(OAuthStorage.reaper)
 
-    @app.before_request
-    async def set_user():
-        g.user = current_user()
+    app.app_ctx_globals_class = LazyUserGlobals
+    app.session_interface = IngestionSessionInterface()
 
     return app
@@ -29,13 +29,19 @@ async def auth():
     if not (form and ('username' in form and 'password' in form)):
         return 'Login Failed', HTTPStatus.BAD_REQUEST
     form: LoginForm = LoginForm(**form)
-    for user in OAuthStorage.users.values():
-        if user.name == form['username'] and user.check_auth(form['password']):
-            session['id'] = user.user_id
-            return 'Login Success', HTTPStatus.OK
+    user = OAuthStorage.find_user(form['username'])
+    if user is not None and user.check_auth(form['password']):
+        session['id'] = user.user_id
+        return 'Login Success', HTTPStatus.OK
     return 'Login Failed', HTTPStatus.BAD_REQUEST
 
 
+@Bp.route('/stats', methods=['GET'])
+@login_required
+async def stats():
+    return OAuthStorage.stats()
+
+
 @Bp.route('/create_client', methods=['GET', 'POST'])
 @login_required
 async def create_client():
@@ -46,7 +52,6 @@ async def create_client():
         scopes=['test']
     )
     client.add()
-    OAuthStorage.save()
 
     return redirect(url_for('http:oauth.authorize'))
 
@@ -64,12 +69,7 @@ async def authorize():
             return error.error
         return render_template('oauthorize.html', user=user, grant=grant)
     if not user and 'username' in form:
-        username = form.get('username')
-        user = None
-        for u in OAuthStorage.users.values():
-            if u.name == username:
-                user = u
-                break
+        user = OAuthStorage.find_user(form.get('username'))
     if form['confirm']:
         grant_user = user
     else:
@@ -1,8 +1,13 @@
+import asyncio
+import collections
 import datetime
 import enum
+import heapq
+import os
 import pickle
 import pathlib
 import random
+import time
 import uuid
 from dataclasses import dataclass, field
 from authlib.oauth2.rfc6749 import TokenMixin, ClientMixin
@@ -10,57 +15,271 @@ from hashlib import sha256
 from enum import StrEnum
 from typing import Optional, Literal
 
+from log import logger
+from storage import SqliteStorage, encode
+
 
 class OAuthStorage:
     base_storage_path = pathlib.Path('./data')
+    flush_window = 1.0  # seconds, changes made within it are written by a single flush
     clients: dict[uuid.UUID, "Client"] = {}
     users: dict[uuid.UUID, "User"] = {}
     tokens: dict[uuid.UUID, "Token"] = {}
+    usernames: dict[str, uuid.UUID] = {}
+    access_tokens: dict[str, uuid.UUID] = {}
+    _dirty: dict[str, set] = {}  # collection name: keys changed since the last flush
+    _flush_handle: Optional[asyncio.TimerHandle] = None
+    reap_interval = 30  # seconds between two reaper passes
+    reap_batch = 256  # tokens evicted before yielding to the loop
+    reaped_tokens = 0
+    _expiry: list[tuple[datetime.datetime, uuid.UUID]] = []  # heap of (expires_at, tid)
+    _revoked: collections.deque[uuid.UUID] = collections.deque()
+    storage: Optional[SqliteStorage] = None  # replaces the data/*.dat files when set
+    _writes: set[asyncio.Task] = set()
+    _dump_lock: Optional[asyncio.Lock] = None
+    refresh_interval = 10  # seconds between two reloads of the rows written by the other workers
+    miss_refresh_interval = 1  # seconds, an unknown access token reloads them at most that often
+    _refreshed = 0.0  # time.monotonic() of the last reload
+    _refreshing: Optional[asyncio.Task] = None
+    _touched: Optional[dict[str, set]] = None  # keys changed while a reload is running, kept as they are
+
+    @classmethod
+    def mark_dirty(cls, collection: Literal['clients', 'users', 'tokens'], key=None):
+        cls._dirty.setdefault(collection, set()).add(key)
+        if cls._touched is not None:
+            cls._touched.setdefault(collection, set()).add(key)
+        cls.schedule_save()
+
+    @classmethod
+    def schedule_save(cls):
+        if cls._flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            cls.save()
+            return
+        cls._flush_handle = loop.call_later(cls.flush_window, cls.save)
+
+    @classmethod
+    def _dump(cls, collection: str, objects: dict):
+        path = cls.base_storage_path / f'{collection}.dat'
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')  # workers may save concurrently
+        with tmp_path.open('wb') as fp:
+            pickle.dump(objects, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    async def _dump_off_loop(cls, collection: str, objects: dict):
+        if cls._dump_lock is None:
+            cls._dump_lock = asyncio.Lock()
+        async with cls._dump_lock:  # one at a time, they share the temporary files
+            await asyncio.to_thread(cls._dump, collection, objects)
 
     @classmethod
     def save(cls):
+        """
+        Write the collections changed since the last save, each one atomically and on a thread when the loop
+        is running
+        """
+        if cls._flush_handle is not None:
+            cls._flush_handle.cancel()
+            cls._flush_handle = None
+        if not cls._dirty:
+            return
+        dirty, cls._dirty = cls._dirty, {}
+        if cls.storage is not None:
+            cls._store(dirty)
+            return
         cls.base_storage_path.mkdir(parents=True, exist_ok=True)
-        tokens_path = cls.base_storage_path / 'tokens.dat'
-        users_path = cls.base_storage_path / 'users.dat'
-        clients_path = cls.base_storage_path / 'clients.dat'
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            for collection in dirty:
+                cls._dump(collection, getattr(cls, collection))
+            return
+        for collection in dirty:
+            # pickled on a thread, from a copy the loop does not change meanwhile
+            task = asyncio.create_task(cls._dump_off_loop(collection, dict(getattr(cls, collection))))
+            cls._writes.add(task)
+            task.add_done_callback(cls._stored)
 
-        if not tokens_path.is_file():
-            tokens_path.unlink(True)
-            tokens_path.touch()
-        with tokens_path.open('wb') as tokens_fp:
-            pickle.dump(cls.tokens, tokens_fp)
+    @classmethod
+    async def close(cls):
+        """
+        Save the changes and wait for the writes
+        """
+        cls.save()
+        if cls._writes:
+            await asyncio.wait(list(cls._writes))
+
+    @classmethod
+    def _store(cls, dirty: dict[str, set]):
+        """
+        Write only the changed rows, on the storage thread pool when the loop is running
+        """
+        writes = []
+        for collection, keys in dirty.items():
+            objects = getattr(cls, collection)
+            keys.discard(None)
+            items = {str(key): encode(objects[key]) for key in keys if key in objects}
+            deleted = [str(key) for key in keys if key not in objects]
+            if items or deleted:
+                writes.append((collection, items, deleted))
+        if not writes:
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            for write in writes:
+                cls.storage.write(*write)
+            return
+        for write in writes:
+            task = asyncio.create_task(cls.storage.run(cls.storage.write, *write))
+            cls._writes.add(task)
+            task.add_done_callback(cls._stored)
 
-        if not users_path.is_file():
-            users_path.unlink(True)
-            users_path.touch()
-        with users_path.open('wb') as users_fp:
-            pickle.dump(cls.users, users_fp)
+    @classmethod
+    def _stored(cls, task: asyncio.Task):
+        cls._writes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.opt(exception=task.exception()).error("Cannot write OAuth data to the storage")
 
-        if not clients_path.is_file():
-            clients_path.unlink(True)
-            clients_path.touch()
-        with clients_path.open('wb') as clients_fp:
-            pickle.dump(cls.clients, clients_fp)
+    @classmethod
+    def use_storage(cls, storage: SqliteStorage):
+        cls.storage = storage
 
     @classmethod
     def load(cls):
-        tokens_path = cls.base_storage_path / 'tokens.dat'
-        users_path = cls.base_storage_path / 'users.dat'
-        clients_path = cls.base_storage_path / 'clients.dat'
+        for collection in ('tokens', 'users', 'clients'):
+            path = cls.base_storage_path / f'{collection}.dat'
+            rows = cls.storage.load(collection) if cls.storage is not None else None
+            if rows:
+                setattr(cls, collection, {uuid.UUID(key): value for key, value in rows.items()})
+            elif path.is_file():
+                with path.open('rb') as fp:
+                    setattr(cls, collection, pickle.load(fp))
+                if rows is not None:
+                    # first start on the storage, migrate the pickled collection
+                    cls._dirty.setdefault(collection, set()).update(getattr(cls, collection))
+            else:
+                cls._dirty.setdefault(collection, set())
+        cls._index()
+        cls.save()
 
-        if tokens_path.is_file():
-            with tokens_path.open('rb') as tokens_fp:
-                cls.tokens = pickle.load(tokens_fp)
+    @classmethod
+    def _index(cls):
+        cls.usernames = {user.name: uid for uid, user in cls.users.items()}
+        cls.access_tokens = {token.access_token: tid for tid, token in cls.tokens.items()}
+        cls._expiry = [(token.expires_at, tid) for tid, token in cls.tokens.items()]
+        heapq.heapify(cls._expiry)
+        cls._revoked = collections.deque(tid for tid, token in cls.tokens.items() if token.revoked)
 
-        if users_path.is_file():
-            with users_path.open('rb') as users_fp:
-                cls.users = pickle.load(users_fp)
+    @classmethod
+    async def refresh(cls, min_interval: float = 0) -> bool:
+        """
+        Reload the collections from the storage, for the users, clients and tokens of the other workers
+        :param min_interval: seconds, nothing is done when the last reload is more recent
+        :return: whether they were reloaded
+        """
+        if cls.storage is None or time.monotonic() - cls._refreshed < min_interval:
+            return False
+        if cls._refreshing is None:
+            cls._refreshing = asyncio.create_task(cls._refresh())
+            cls._refreshing.add_done_callback(lambda _: setattr(cls, '_refreshing', None))
+        await asyncio.shield(cls._refreshing)
+        return True
 
-        if clients_path.is_file():
-            with clients_path.open('rb') as clients_fp:
-                cls.clients = pickle.load(clients_fp)
+    @classmethod
+    async def _refresh(cls):
+        cls._refreshed = time.monotonic()
+        cls._touched = {}
+        try:
+            cls.save()
+            if cls._writes:
+                await asyncio.wait(list(cls._writes))
+            loaded = await cls.storage.run(
+                lambda: {collection: cls.storage.load(collection) for collection in ('tokens', 'users', 'clients')}
+            )
+            for collection, rows in loaded.items():
+                objects = {uuid.UUID(key): value for key, value in rows.items()}
+                current = getattr(cls, collection)
+                # changed here meanwhile, the rows may predate them
+                for key in cls._touched.get(collection, set()) | cls._dirty.get(collection, set()):
+                    if key in current:
+                        objects[key] = current[key]
+                    else:
+                        objects.pop(key, None)
+                setattr(cls, collection, objects)
+        finally:
+            cls._touched = None
+        cls._index()
 
-        cls.save()
+    @classmethod
+    def find_user(cls, name: str) -> Optional["User"]:
+        uid = cls.usernames.get(name)
+        return None if uid is None else cls.users.get(uid)
+
+    @classmethod
+    def find_token(cls, access_token: str) -> Optional["Token"]:
+        tid = cls.access_tokens.get(access_token)
+        return None if tid is None else cls.tokens.get(tid)
+
+    @classmethod
+    def reap(cls, now: datetime.datetime = None) -> int:
+        """
+        Evict at most ``reap_batch`` expired or revoked tokens
+        :return: the number of evicted tokens
+        """
+        if now is None:
+            now = datetime.datetime.utcnow()
+        reaped = 0
+        while cls._expiry and reaped < cls.reap_batch and cls._expiry[0][0] < now:
+            expires_at, tid = heapq.heappop(cls._expiry)
+            token = cls.tokens.get(tid)
+            # skip entries left behind by tokens already deleted or given a new expiry
+            if token is not None and token.expires_at == expires_at:
+                token.delete()
+                reaped += 1
+        while cls._revoked and reaped < cls.reap_batch:
+            token = cls.tokens.get(cls._revoked.popleft())
+            if token is not None:
+                token.delete()
+                reaped += 1
+        cls.reaped_tokens += reaped
+        return reaped
+
+    @classmethod
+    async def reaper(cls):
+        async def reap_periodically():
+            while True:
+                await asyncio.sleep(cls.reap_interval)
+                while cls.reap() == cls.reap_batch:
+                    await asyncio.sleep(0)
+
+        async def refresh_periodically():
+            while True:
+                await asyncio.sleep(cls.refresh_interval)
+                try:
+                    await cls.refresh()
+                except Exception as e:
+                    logger.opt(exception=e).error("Cannot reload the OAuth data from the storage")
+
+        tasks = [asyncio.create_task(reap_periodically())]
+        if cls.storage is not None:
+            tasks.append(asyncio.create_task(refresh_periodically()))
+        yield
+        for task in tasks:
+            task.cancel()
+
+    @classmethod
+    def stats(cls) -> dict[str, int]:
+        return {
+            'live_tokens': len(cls.tokens),
+            'reaped_tokens': cls.reaped_tokens,
+        }
 
 
 @dataclass
@@ -81,6 +300,12 @@ class User:
     def get_user_id(self) -> int:
         return self.uid.int
 
+    def add(self):
+        if self.uid not in OAuthStorage.users:
+            OAuthStorage.users[self.uid] = self
+            OAuthStorage.usernames[self.name] = self.uid
+            OAuthStorage.mark_dirty('users', self.uid)
+
     def __hash__(self):
         return hash(self.uid)
 
@@ -102,8 +327,9 @@ class Client(ClientMixin):
             self.cid = uuid.uuid4()
 
     def add(self):
-        if self.cid not in OAuthStorage.users:
-            OAuthStorage.users[self.cid] = self
+        if self.cid not in OAuthStorage.clients:
+            OAuthStorage.clients[self.cid] = self
+            OAuthStorage.mark_dirty('clients', self.cid)
 
     @property
     def grant_types(self):
@@ -178,9 +404,19 @@ class Token(TokenMixin):
     def add(self):
         if self.tid not in OAuthStorage.tokens:
             OAuthStorage.tokens[self.tid] = self
+            OAuthStorage.access_tokens[self.access_token] = self.tid
+            heapq.heappush(OAuthStorage._expiry, (self.expires_at, self.tid))
+            OAuthStorage.mark_dirty('tokens', self.tid)
+
+    def revoke(self):
+        self.revoked = True
+        OAuthStorage._revoked.append(self.tid)
+        OAuthStorage.mark_dirty('tokens', self.tid)
 
     def delete(self):
         OAuthStorage.tokens.pop(self.tid)
+        OAuthStorage.access_tokens.pop(self.access_token, None)
+        OAuthStorage.mark_dirty('tokens', self.tid)
 
     @property
     def client_id(self) -> str:
@@ -1,30 +1,93 @@
 import asyncio
+import multiprocessing
+import multiprocessing.connection
+import os
+import pathlib
 import signal
+import socket
 from typing import Any
 
 from hypercorn.asyncio import serve
 from hypercorn.config import Config
 from create_app import create_app
 from ever_loguru import install_handlers
+from service.heartbeat import Heartbeat
+from service.ingest import IngestQueue
+from service.manager import PluginService
 
-install_handlers()
+HOST = '0.0.0.0'
+PORT = 51490
+WORKERS = int(os.environ.get('WORKERS', 1))  # one per core, workers share the port through SO_REUSEPORT
 
-app = create_app()
 
-config = Config()
-config.bind = ['0.0.0.0:51490']
+def reuse_port_socket() -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((HOST, PORT))
+    return sock
 
-shutdown_event = asyncio.Event()
 
+def run_worker(index: int = 0):
+    install_handlers()
 
-def _signal_handler(*_: Any) -> None:
-    shutdown_event.set()
+    config = Config()
+    if WORKERS > 1:
+        # the kernel balances the connections between the sockets of the workers
+        sock = reuse_port_socket()
+        config.bind = [f'fd://{sock.fileno()}']
+        os.environ.setdefault('QUART_BUS', 'unix')
+        PluginService.primary = index == 0
+        PluginService.worker = str(index)
+        IngestQueue.wal.path = pathlib.Path(f'./ingest-{index}.wal')
+    else:
+        config.bind = [f'{HOST}:{PORT}']
 
+    app = create_app()
+    # control frame pings for the clients that did not negotiate heartbeat events
+    config.websocket_ping_interval = Heartbeat.ping_interval or None
 
-loop = asyncio.new_event_loop()
-asyncio.set_event_loop(loop)
-loop.add_signal_handler(signal.SIGINT, _signal_handler)
-loop.add_signal_handler(signal.SIGTERM, _signal_handler)
-loop.run_until_complete(
-    serve(app, config, shutdown_trigger=shutdown_event.wait)
-)
+    shutdown_event = asyncio.Event()
+
+    def _signal_handler(*_: Any) -> None:
+        shutdown_event.set()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.add_signal_handler(signal.SIGINT, _signal_handler)
+    loop.add_signal_handler(signal.SIGTERM, _signal_handler)
+    loop.run_until_complete(
+        serve(app, config, shutdown_trigger=shutdown_event.wait)
+    )
+
+
+def main():
+    if WORKERS <= 1:
+        run_worker()
+        return
+    # the workers share the events, the crash aggregates, the registry and the OAuth data through it
+    storage = os.environ.setdefault('QUART_STORAGE', 'sqlite')
+    if storage != 'sqlite':
+        raise SystemExit(f'WORKERS={WORKERS} needs QUART_STORAGE=sqlite, not {storage}')
+
+    workers = [multiprocessing.Process(target=run_worker, args=(index,), name=f'worker-{index}')
+               for index in range(WORKERS)]
+    for worker in workers:
+        worker.start()
+
+    def _signal_handler(signum: int = signal.SIGTERM, *_: Any) -> None:
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signum)
+
+    signal.signal(signal.SIGINT, _signal_handler)
+    signal.signal(signal.SIGTERM, _signal_handler)
+    # a worker exiting on its own takes the others down, instead of serving with a part of the cores
+    multiprocessing.connection.wait([worker.sentinel for worker in workers])
+    _signal_handler()
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == '__main__':
+    main()
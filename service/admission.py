@@ -0,0 +1,120 @@
+import random
+import time
+import uuid
+from typing import Optional
+
+
+class TokenBucket:
+    """
+    ``rate`` tokens per second, at most ``burst`` saved up
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now: float = None) -> bool:
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def give_back(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    def wait_time(self) -> float:
+        """
+        Seconds until the next token
+        """
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class Admission:
+    """
+    Admission control of new websocket connections
+
+    A connection takes a token from the global bucket and one from the bucket of its plugin, and holds a
+    handshake slot until its client is set up. When any of them is exhausted, the connection is closed with
+    ``close_code`` and a ``retry-after=<seconds>`` reason, jittered so deferred clients do not come back at once.
+    """
+    rate = 200.0  # new connections per second, all plugins together
+    burst = 400.0
+    plugin_rate = 50.0  # new connections per second of one plugin
+    plugin_burst = 100.0
+    max_handshakes = 256  # connections between the upgrade and their client set up
+    handshake_timeout = 10.0  # seconds for the ClientInfo to arrive
+    retry_after = 1.0  # seconds, the shortest hint given
+    close_code = 1013  # Try Again Later
+    bucket = TokenBucket(rate, burst)
+    plugin_buckets: dict[uuid.UUID, TokenBucket] = {}
+    handshakes = 0
+    admitted = 0
+    deferred = 0
+
+    @classmethod
+    def configure(cls, rate: float = None, burst: float = None, plugin_rate: float = None,
+                  plugin_burst: float = None, max_handshakes: int = None):
+        cls.rate = rate or cls.rate
+        cls.burst = burst or cls.burst
+        cls.plugin_rate = plugin_rate or cls.plugin_rate
+        cls.plugin_burst = plugin_burst or cls.plugin_burst
+        cls.max_handshakes = max_handshakes or cls.max_handshakes
+        cls.bucket = TokenBucket(cls.rate, cls.burst)
+        cls.plugin_buckets = {}
+
+    @classmethod
+    def enter(cls) -> Optional[float]:
+        """
+        Start a handshake, to be followed by ``leave`` once admitted
+        :return: None when the connection may proceed, the retry-after hint otherwise
+        """
+        if cls.handshakes >= cls.max_handshakes:
+            return cls._defer(cls.retry_after)
+        if not cls.bucket.take():
+            return cls._defer(cls.bucket.wait_time())
+        cls.handshakes += 1
+        return None
+
+    @classmethod
+    def admit(cls, sid: uuid.UUID) -> Optional[float]:
+        """
+        Check the bucket of the plugin, once the plugin of the connection is known
+        :return: None when the connection is admitted, the retry-after hint otherwise
+        """
+        bucket = cls.plugin_buckets.get(sid)
+        if bucket is None:
+            bucket = cls.plugin_buckets[sid] = TokenBucket(cls.plugin_rate, cls.plugin_burst)
+        if not bucket.take():
+            cls.bucket.give_back()  # this connection did not cost the other plugins anything
+            return cls._defer(bucket.wait_time())
+        cls.admitted += 1
+        return None
+
+    @classmethod
+    def leave(cls):
+        cls.handshakes -= 1
+
+    @classmethod
+    def _defer(cls, wait: float) -> float:
+        cls.deferred += 1
+        return round(max(wait, cls.retry_after) * random.uniform(1, 2), 2)
+
+    @classmethod
+    def reason(cls, retry_after: float) -> str:
+        return f'retry-after={retry_after}'
+
+    @classmethod
+    def stats(cls) -> dict[str, int]:
+        return {
+            'admitted': cls.admitted,
+            'deferred': cls.deferred,
+            'handshakes': cls.handshakes,
+        }
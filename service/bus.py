@@ -0,0 +1,117 @@
+import asyncio
+import os
+import pathlib
+import socket
+from typing import Callable, Optional
+
+from quart import json
+
+from log import logger
+
+BusHandler = Callable[[dict], None]
+
+
+class Bus:
+    """
+    Publish/subscribe between the workers serving the same services
+
+    The base bus is the single worker case: there is nobody to talk to, so publishing does nothing.
+    Records are small JSON-able dicts with an ``op`` key, the same shape as the records of the services journal.
+    """
+
+    def __init__(self):
+        self.handler: Optional[BusHandler] = None
+
+    async def start(self, handler: BusHandler):
+        """
+        :param handler: called with every record published by another worker
+        """
+        self.handler = handler
+
+    def publish(self, record: dict):
+        pass
+
+    async def close(self):
+        self.handler = None
+
+
+class UnixSocketBus(Bus):
+    """
+    Broker-less bus over Unix datagram sockets
+
+    Every worker binds ``<path>/<pid>.sock`` and publishing sends the record to every other socket of the
+    directory. A datagram is delivered whole or not at all, so no framing is needed. Sockets left by dead
+    workers are removed on the first failed send.
+    """
+    path = pathlib.Path('./run/bus')
+    max_record_size = 64 * 1024  # bytes, bigger records are dropped with a warning
+
+    def __init__(self, path: pathlib.Path = None):
+        super().__init__()
+        if path is not None:
+            self.path = path
+        self.sock: Optional[socket.socket] = None
+        self.address: Optional[pathlib.Path] = None
+        self.published = 0
+        self.received = 0
+        self.failed = 0
+
+    async def start(self, handler: BusHandler):
+        await super().start(handler)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.address = self.path / f'{os.getpid()}.sock'
+        self.address.unlink(True)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(str(self.address))
+        self.sock.setblocking(False)
+        asyncio.get_running_loop().add_reader(self.sock.fileno(), self._read)
+        logger.info("Bus listening on {address}", address=self.address)
+
+    def peers(self) -> list[pathlib.Path]:
+        return [peer for peer in self.path.glob('*.sock') if peer != self.address]
+
+    def publish(self, record: dict):
+        if self.sock is None:
+            return
+        data = json.dumps(record, ensure_ascii=False).encode('u8')
+        if len(data) > self.max_record_size:
+            logger.warning("Bus record of {size} bytes is too large, dropped: {op}", size=len(data), op=record['op'])
+            self.failed += 1
+            return
+        for peer in self.peers():
+            try:
+                self.sock.sendto(data, str(peer))
+            except (ConnectionRefusedError, FileNotFoundError):
+                # the worker is gone
+                peer.unlink(True)
+            except BlockingIOError:
+                # the worker does not keep up, the record is lost for it rather than stalling this one
+                self.failed += 1
+                logger.warning("Bus peer {peer} is full, record dropped: {op}", peer=peer, op=record['op'])
+        self.published += 1
+
+    def _read(self):
+        while True:
+            try:
+                data = self.sock.recv(self.max_record_size)
+            except (BlockingIOError, InterruptedError):
+                return
+            self.received += 1
+            try:
+                self.handler(json.loads(data))
+            except Exception as e:
+                logger.exception("Cannot handle bus record {data}: {e}", data=data, e=e)
+
+    async def close(self):
+        if self.sock is not None:
+            asyncio.get_running_loop().remove_reader(self.sock.fileno())
+            self.sock.close()
+            self.sock = None
+            self.address.unlink(True)
+        await super().close()
+
+
+BUSES: dict[str, type[Bus]] = {
+    'local': Bus,
+    'unix': UnixSocketBus,
+}
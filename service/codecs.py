@@ -0,0 +1,88 @@
+import datetime
+import uuid
+import zlib
+from dataclasses import asdict, is_dataclass
+from typing import Any, TYPE_CHECKING
+
+from quart import json
+from werkzeug.http import http_date
+
+try:
+    import msgpack
+except ImportError:  # optional, the msgpack encoding is only offered when it is installed
+    msgpack = None
+
+if TYPE_CHECKING:
+    from .frames import Frame
+
+
+class Codec:
+    """
+    Wire encoding of the events of a websocket client, negotiated by ``ClientInfo.encoding``
+
+    Uplink frames sent as text are always read as JSON, so a client may keep sending JSON whatever it receives.
+    """
+    name = 'json'
+    binary = False
+    errors: tuple[type[Exception], ...] = (ValueError,)  # raised by decode for a frame that cannot be read
+
+    def encode(self, frame: "Frame") -> str | bytes:
+        return frame.data
+
+    def decode(self, data: str | bytes) -> Any:
+        return json.loads(data)
+
+
+class ZlibCodec(Codec):
+    """
+    Deflated JSON in binary frames, for clients behind proxies that strip permessage-deflate
+    """
+    name = 'zlib'
+    binary = True
+    errors = (ValueError, zlib.error)
+    level = 6
+    max_size = 16 * 1024 * 1024  # bytes of an uplink frame once inflated, hypercorn's default message limit
+
+    def encode(self, frame: "Frame") -> bytes:
+        return zlib.compress(frame.data.encode('u8'), self.level)
+
+    def decode(self, data: str | bytes) -> Any:
+        if isinstance(data, str):
+            return json.loads(data)
+        # bounded, a small frame may inflate to gigabytes
+        decompressor = zlib.decompressobj()
+        inflated = decompressor.decompress(data, self.max_size)
+        if decompressor.unconsumed_tail:
+            raise ValueError(f'Frame larger than {self.max_size} bytes once inflated')
+        return json.loads(inflated)
+
+
+def _msgpack_default(obj: Any) -> Any:
+    """
+    The values msgpack cannot pack, encoded like the JSON frames encode them
+    """
+    if isinstance(obj, datetime.date):
+        return http_date(obj)
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if is_dataclass(obj):
+        return asdict(obj)
+    raise TypeError(f'Object of type {type(obj).__name__} cannot be packed')
+
+
+class MsgpackCodec(Codec):
+    name = 'msgpack'
+    binary = True
+
+    def encode(self, frame: "Frame") -> bytes:
+        return msgpack.packb(asdict(frame.event), default=_msgpack_default)
+
+    def decode(self, data: str | bytes) -> Any:
+        if isinstance(data, str):
+            return json.loads(data)
+        return msgpack.unpackb(data)
+
+
+CODECS: dict[str, Codec] = {codec.name: codec for codec in (Codec(), ZlibCodec())}
+if msgpack is not None:
+    CODECS['msgpack'] = MsgpackCodec()
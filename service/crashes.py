@@ -0,0 +1,218 @@
+import collections
+import dataclasses
+import hashlib
+import heapq
+import random
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Any, Iterable, Optional, Sequence
+
+from .structures import UpEvent, ReportEvent, ReportLevel
+
+UUID_PATTERN = re.compile(r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}')
+HEX_PATTERN = re.compile(r'\b0x[0-9a-fA-F]+\b')
+NUMBER_PATTERN = re.compile(r'\b\d+(\.\d+)?\b')
+QUOTED_PATTERN = re.compile(r'"[^"]*"|\'[^\']*\'|`[^`]*`')
+POSITION_PATTERN = re.compile(r':\d+(:\d+)?(?=\)?$)')  # line and column at the end of a frame
+QUERY_PATTERN = re.compile(r'\?[^\s):]*')  # cache busters of the script URLs
+
+
+def normalize_message(message: str) -> str:
+    """
+    The message with its variable parts (ids, addresses, numbers, quoted values) replaced by placeholders
+    """
+    message = UUID_PATTERN.sub('<uuid>', message)
+    message = HEX_PATTERN.sub('<hex>', message)
+    message = QUOTED_PATTERN.sub('<str>', message)
+    return NUMBER_PATTERN.sub('<n>', message)
+
+
+def normalize_stack(stack: str, depth: int = 8) -> str:
+    """
+    The first ``depth`` frames of the stack without their positions and query strings, which change with every
+    build of the plugin while the crash stays the same
+    """
+    frames = []
+    for line in stack.splitlines():
+        line = line.strip()
+        if not line.startswith('at ') and '@' not in line:
+            continue  # the message repeated by V8, or a line that is not a frame
+        line = QUERY_PATTERN.sub('', POSITION_PATTERN.sub('', line))
+        frames.append(UUID_PATTERN.sub('<uuid>', line))
+        if len(frames) == depth:
+            break
+    return '\n'.join(frames)
+
+
+def fingerprint(report: ReportEvent) -> Optional[str]:
+    """
+    Identify the crash behind a report, from the error name, the normalized message and the normalized stack
+    :return: None for a report without an error
+    """
+    error = report.error
+    if not error:
+        return None
+    key = '\n'.join((
+        str(error.get('name')),
+        normalize_message(str(error.get('message') or '')),
+        normalize_stack(error.get('stack') or ''),
+    ))
+    return hashlib.blake2b(key.encode('u8', 'replace'), digest_size=8).hexdigest()
+
+
+@dataclass
+class CrashAggregate:
+    """
+    Crash Aggregate: the reports of one fingerprint
+    :var count: reports received, stored or folded
+    :var first_seen: server time of the first report
+    :var last_seen: server time of the last report
+    :var samples: a uniform random sample of the reports, the first one included
+    :var stored_at: server time of the last report stored in full
+    """
+    fingerprint: str
+    name: str
+    message: str
+    level: ReportLevel
+    count: int = 0
+    first_seen: float = 0.0
+    last_seen: float = 0.0
+    samples: list[ReportEvent] = field(default_factory=list)
+    stored_at: float = 0.0
+
+    def summary(self) -> dict[str, Any]:
+        return {
+            'fingerprint': self.fingerprint,
+            'name': self.name,
+            'message': self.message,
+            'level': self.level,
+            'count': self.count,
+            'first_seen': self.first_seen,
+            'last_seen': self.last_seen,
+        }
+
+
+class Crashes:
+    """
+    Crash aggregates of one plugin
+
+    The first report of a fingerprint is stored as usual, the repeats are folded into its aggregate and only
+    kept in its reservoir sample. A repeat is stored in full again once ``store_interval`` passed since the
+    last stored one, so the history still shows a crash coming back.
+    """
+    sample_size = 5
+    store_interval = 3600.0  # seconds
+    max_aggregates = 1000  # the least recently seen are forgotten beyond it
+    changed = False  # aggregates created or updated since the owner last saved them
+
+    def __init__(self):
+        self.aggregates: collections.OrderedDict[str, CrashAggregate] = collections.OrderedDict()
+        self.folded = 0
+
+    def fold(self, events: Sequence[UpEvent]) -> Sequence[UpEvent]:
+        """
+        Fold the repeated crash reports into their aggregates
+        :return: the events to store and dispatch, the events given when none is folded
+        """
+        kept = None
+        now = time.time()
+        for index, event in enumerate(events):
+            if not isinstance(event, ReportEvent) or (key := fingerprint(event)) is None:
+                if kept is not None:
+                    kept.append(event)
+                continue
+            self.changed = True
+            if self._add(key, event, now):
+                if kept is not None:
+                    kept.append(event)
+            elif kept is None:
+                kept = list(events[:index])
+        return events if kept is None else kept
+
+    def _add(self, key: str, report: ReportEvent, now: float) -> bool:
+        """
+        :return: whether the report is to be stored
+        """
+        aggregate = self.aggregates.get(key)
+        if aggregate is None:
+            aggregate = self.aggregates[key] = CrashAggregate(
+                key, str(report.error.get('name')), str(report.error.get('message')), report.level,
+                count=1, first_seen=now, last_seen=now, samples=[report], stored_at=now,
+            )
+            if len(self.aggregates) > self.max_aggregates:
+                self.aggregates.popitem(last=False)
+            return True
+        self.aggregates.move_to_end(key)
+        aggregate.count += 1
+        aggregate.last_seen = now
+        # reservoir sampling: every report of the fingerprint ends up in the sample with the same probability
+        if len(aggregate.samples) < self.sample_size:
+            aggregate.samples.append(report)
+        elif (slot := random.randrange(aggregate.count)) < self.sample_size:
+            aggregate.samples[slot] = report
+        if now - aggregate.stored_at >= self.store_interval:
+            aggregate.stored_at = now
+            return True
+        self.folded += 1
+        return False
+
+    def copy(self) -> "Crashes":
+        clone = Crashes()
+        clone.aggregates = collections.OrderedDict(
+            (key, dataclasses.replace(aggregate, samples=list(aggregate.samples)))
+            for key, aggregate in self.aggregates.items()
+        )
+        clone.folded = self.folded
+        return clone
+
+    @classmethod
+    def merged(cls, parts: Iterable["Crashes"]) -> "Crashes":
+        """
+        The aggregates of several workers together, with the samples of each up to ``sample_size``
+        """
+        merged = Crashes()
+        for part in parts:
+            merged.folded += part.folded
+            for key, aggregate in part.aggregates.items():
+                into = merged.aggregates.get(key)
+                if into is None:
+                    merged.aggregates[key] = dataclasses.replace(aggregate, samples=list(aggregate.samples))
+                    continue
+                into.count += aggregate.count
+                into.first_seen = min(into.first_seen, aggregate.first_seen)
+                into.last_seen = max(into.last_seen, aggregate.last_seen)
+                into.stored_at = max(into.stored_at, aggregate.stored_at)
+                into.samples.extend(aggregate.samples[:cls.sample_size - len(into.samples)])
+        return merged
+
+    def get(self, key: str) -> Optional[CrashAggregate]:
+        return self.aggregates.get(key)
+
+    def query(self, level: Optional[ReportLevel] = None, since: Optional[float] = None, until: Optional[float] = None,
+              limit: int = 50, cursor: Optional[str] = None) -> tuple[list[CrashAggregate], Optional[str]]:
+        """
+        Find aggregates seen within since/until, most recently seen first
+        :param cursor: the cursor returned by the previous page, None for the first page
+        :return: aggregates and the cursor of the next page (None when exhausted)
+        :raise ValueError: the cursor is invalid
+        """
+        bound = None
+        if cursor is not None:
+            # (last_seen, fingerprint) of the last aggregate of the previous page, stable while they are updated
+            last_seen, _, key = cursor.rpartition(':')
+            bound = (float(last_seen), key)
+        found = heapq.nlargest(limit + 1, (
+            aggregate for aggregate in self.aggregates.values()
+            if (level is None or aggregate.level == level)
+            and (since is None or aggregate.last_seen >= since)
+            and (until is None or aggregate.first_seen <= until)
+            and (bound is None or (aggregate.last_seen, aggregate.fingerprint) < bound)
+        ), key=lambda aggregate: (aggregate.last_seen, aggregate.fingerprint))
+        if len(found) <= limit:
+            return found, None
+        del found[limit:]
+        return found, f'{found[-1].last_seen!r}:{found[-1].fingerprint}'
+
+    def __len__(self):
+        return len(self.aggregates)
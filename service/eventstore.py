@@ -0,0 +1,206 @@
+import asyncio
+import bisect
+import collections
+import itertools
+import pathlib
+import pickle
+import secrets
+import uuid
+from typing import Any, Iterable, Iterator, Optional
+
+from log import logger
+from storage import SqliteStorage
+from .reportindex import ReportIndex, timestamp_of
+from .structures import UpEvent, UpEventType, ReportLevel, ReportEvent
+
+
+def event_columns(event: UpEvent) -> tuple[str, Optional[str], Optional[str], Optional[float]]:
+    """
+    The (type, level, cid, timestamp) the events table is queried by
+    """
+    if not isinstance(event, ReportEvent):
+        return str(event.type), None, None, None
+    return str(event.type), str(event.level), None if event.cid is None else str(event.cid), \
+        timestamp_of(event.timestamp)
+
+
+class EventStore:
+    """
+    Event history of one plugin: the latest events stay in a bounded in-memory ring, older ones spill to
+    on-disk chunks. It behaves like a read-only sequence over the whole history.
+
+    Chunks are pickled and written on a thread when the loop is running, until then they are read from memory.
+    With the sqlite storage, the events table is the history of every plugin and the store keeps nothing.
+    """
+    base_path = pathlib.Path('./events')
+    max_events = 1000  # in-memory events per plugin, unless the plugin sets its own limit
+    spill_batch = 256  # events written per chunk
+    storage: Optional[SqliteStorage] = None  # set in sqlite mode, events are then queried from it
+
+    def __init__(self, sid: uuid.UUID, max_events: Optional[int] = None):
+        self.sid = sid
+        self.max_events = max_events
+        self.recent: collections.deque[UpEvent] = collections.deque()
+        self.chunks: list[int] = []  # global index of the first event of each chunk
+        self.tags: dict[int, str] = {}  # in the file name of each chunk, so none is ever overwritten
+        self.spilled = 0
+        self.index = ReportIndex()
+        self._cache: dict[int, list[UpEvent]] = {}
+        self._unwritten: dict[int, list[UpEvent]] = {}  # chunks spilled but not on disk yet
+
+    @property
+    def limit(self) -> int:
+        return self.max_events or type(self).max_events
+
+    @limit.setter
+    def limit(self, value: Optional[int]):
+        self.max_events = value
+        self._spill()
+
+    @property
+    def path(self) -> pathlib.Path:
+        return self.base_path / str(self.sid)
+
+    def append(self, event: UpEvent):
+        if self.storage is not None:
+            return
+        self.index.add(len(self), event)
+        self.recent.append(event)
+        if len(self.recent) > self.limit:
+            self._spill()
+
+    def extend(self, events: Iterable[UpEvent]):
+        if self.storage is not None:
+            return
+        for event in events:
+            self.index.add(len(self), event)
+            self.recent.append(event)
+        if len(self.recent) > self.limit:
+            self._spill()
+
+    async def query(self, type: str = UpEventType.report, level: Optional[ReportLevel] = None,
+                    cid: Optional[str] = None, since: Optional[float] = None, until: Optional[float] = None,
+                    limit: int = 50, cursor: Optional[int] = None) -> tuple[list[UpEvent], Optional[int]]:
+        """
+        Look events up through the index, or the events table in sqlite mode, newest first,
+        see ``ReportIndex.query``
+        """
+        if self.storage is not None:
+            return await self.storage.run(
+                self.storage.query_events, str(self.sid), str(type), None if level is None else str(level),
+                None if cid is None else str(cid), since, until, limit, cursor
+            )
+        positions, cursor = self.index.query(type, level, cid, since, until, limit, cursor)
+        return [self[position] for position in positions], cursor
+
+    def _spill(self):
+        limit = self.limit
+        if len(self.recent) <= limit:
+            return
+        keep = max(0, limit - max(1, min(self.spill_batch, limit)))
+        chunk = [self.recent.popleft() for _ in range(len(self.recent) - keep)]
+        start = self.spilled
+        # unique, the history of a snapshot restored after a crash may use the same start again
+        self.tags[start] = secrets.token_hex(4)
+        self.chunks.append(start)
+        self.spilled += len(chunk)
+        self._unwritten[start] = chunk
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write_chunk(start, chunk)
+            self._unwritten.pop(start)
+            return
+        future = loop.run_in_executor(None, self._write_chunk, start, chunk)
+        future.add_done_callback(lambda f: self._written(start, f))
+
+    def _write_chunk(self, start: int, chunk: list[UpEvent]):
+        self.path.mkdir(parents=True, exist_ok=True)
+        with self._chunk_path(start).open('wb') as fp:
+            pickle.dump(chunk, fp)
+        logger.debug("Spilled {count} events of {sid}", count=len(chunk), sid=self.sid)
+
+    def _written(self, start: int, future: asyncio.Future):
+        if future.exception() is not None:
+            # kept in memory, and in the snapshots, rather than lost
+            logger.opt(exception=future.exception()).error("Cannot spill the events of {sid}", sid=self.sid)
+            return
+        self._unwritten.pop(start, None)
+
+    def _chunk_path(self, start: int) -> pathlib.Path:
+        tag = self.tags.get(start)
+        return self.path / (f'{start:012d}.pkl' if tag is None else f'{start:012d}-{tag}.pkl')
+
+    def _load_chunk(self, start: int) -> list[UpEvent]:
+        chunk = self._unwritten.get(start) or self._cache.get(start)
+        if chunk is None:
+            with self._chunk_path(start).open('rb') as fp:
+                chunk = pickle.load(fp)
+            if len(self._cache) >= 2:
+                self._cache.pop(next(iter(self._cache)))
+            self._cache[start] = chunk
+        return chunk
+
+    def page(self, offset: int = 0, limit: Optional[int] = None) -> list[UpEvent]:
+        """
+        Fetch events by their position in the whole history, reading spilled chunks when needed
+        :param offset: position of the first event
+        :param limit: maximum number of events, everything after ``offset`` if None
+        """
+        end = len(self) if limit is None else min(len(self), offset + limit)
+        result = []
+        position = max(0, offset)
+        while position < min(end, self.spilled):
+            i = bisect.bisect_right(self.chunks, position) - 1
+            start = self.chunks[i]
+            chunk = self._load_chunk(start)
+            result.extend(chunk[position - start:end - start])
+            position = start + len(chunk)
+        if position < end:
+            result.extend(itertools.islice(self.recent, position - self.spilled, end - self.spilled))
+        return result
+
+    def __len__(self):
+        return self.spilled + len(self.recent)
+
+    def __getitem__(self, item: int) -> UpEvent:
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError(item)
+        return self.page(item, 1)[0]
+
+    def __iter__(self) -> Iterator[UpEvent]:
+        for start in self.chunks:
+            yield from self._load_chunk(start)
+        yield from self.recent
+
+    def copy(self) -> "EventStore":
+        """
+        A copy that does not change with this store, for a snapshot written off the loop. Events are shared,
+        they are not modified once stored.
+        """
+        clone = object.__new__(EventStore)
+        clone.__dict__.update(self.__getstate__())
+        clone.recent = collections.deque(self.recent)
+        clone.chunks = list(self.chunks)
+        clone.tags = dict(self.tags)
+        clone._unwritten = dict(self._unwritten)
+        clone.index = self.index.copy()
+        return clone
+
+    def __getstate__(self) -> dict[str, Any]:
+        state = self.__dict__.copy()
+        state['_cache'] = {}
+        return state
+
+    def __setstate__(self, state: dict[str, Any]):
+        self.__dict__.update(state)
+        # chunks still being written when the snapshot was taken
+        for start, chunk in self.__dict__.pop('_unwritten', {}).items():
+            self._write_chunk(start, chunk)
+        self._unwritten = {}
+        if 'index' not in state:
+            self.index = ReportIndex()
+            for position, event in enumerate(self):
+                self.index.add(position, event)
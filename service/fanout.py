@@ -0,0 +1,70 @@
+import asyncio
+import collections
+from typing import Optional
+
+from .frames import Frame
+from .structures import DownEvent, OverflowPolicy
+
+
+class DownQueue:
+    """
+    Bounded queue of the encoded down events of one client
+
+    Offering never waits: once the queue is full, the overflow policy decides what is dropped.
+    """
+    __slots__ = ('events', 'maxsize', 'policy', 'dropped', '_waiter')
+
+    def __init__(self, maxsize: int = 50, policy: OverflowPolicy = OverflowPolicy.drop_oldest):
+        self.events: collections.deque[Frame | DownEvent] = collections.deque()
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        self._waiter: Optional[asyncio.Future] = None
+
+    def offer(self, event: Frame) -> bool:
+        """
+        :return: False if the event was refused and the client has to be disconnected
+        """
+        if len(self.events) >= self.maxsize:
+            if self.policy == OverflowPolicy.drop_newest:
+                self.dropped += 1
+                return True
+            elif self.policy == OverflowPolicy.disconnect:
+                self.dropped += 1
+                return False
+            elif self.policy == OverflowPolicy.coalesce:
+                kept = [queued for queued in self.events if queued.type != event.type]
+                if len(kept) < len(self.events):
+                    self.dropped += len(self.events) - len(kept)
+                    self.events = collections.deque(kept)
+                else:
+                    self.events.popleft()
+                    self.dropped += 1
+            else:
+                self.events.popleft()
+                self.dropped += 1
+        self.put_nowait(event)
+        return True
+
+    def put_nowait(self, event: Frame | DownEvent):
+        """
+        Queue an event regardless of the size limit, for control events
+        """
+        self.events.append(event)
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    async def get(self) -> Frame | DownEvent:
+        while not self.events:
+            self._waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        return self.events.popleft()
+
+    def popleft(self) -> Frame | DownEvent:
+        return self.events.popleft()
+
+    def __len__(self):
+        return len(self.events)
@@ -0,0 +1,38 @@
+from dataclasses import asdict
+from typing import Optional
+
+from quart import json
+
+from .codecs import Codec
+from .structures import DownEvent
+
+
+class Frame:
+    """
+    A down event encoded once, shared by every client it is sent to
+
+    ``data`` is the JSON text, other encodings are made on first use and kept for the next clients.
+    """
+    __slots__ = ('event', 'data', '_encoded')
+
+    def __init__(self, event: DownEvent):
+        self.event = event
+        self.data: str = json.dumps(asdict(event), ensure_ascii=False)
+        self._encoded: Optional[dict[str, str | bytes]] = None
+
+    def encoded(self, codec: Codec) -> str | bytes:
+        if not codec.binary:
+            return self.data
+        if self._encoded is None:
+            self._encoded = {}
+        data = self._encoded.get(codec.name)
+        if data is None:
+            data = self._encoded[codec.name] = codec.encode(self)
+        return data
+
+    @property
+    def type(self):
+        return self.event.type
+
+    def __repr__(self):
+        return f"<Frame {self.data}>"
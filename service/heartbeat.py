@@ -0,0 +1,90 @@
+import asyncio
+import heapq
+import itertools
+import time
+from typing import TYPE_CHECKING
+
+from log import logger
+from .frames import Frame
+from .structures import PingEvent
+
+if TYPE_CHECKING:
+    from .manager import BaseServiceClient
+
+
+class Heartbeat:
+    """
+    Pings idle websocket clients and evicts the ones that stopped answering
+
+    All connections share one heap of deadlines checked by a single task, a connection costs a heap entry and
+    its ``last_seen`` time, which the engines update on every frame received. Any frame counts as an answer.
+    Only the clients that negotiated ``heartbeat`` are watched, the others may not know ping events: the server
+    pings them with websocket control frames instead (hypercorn's ``websocket_ping_interval``).
+    """
+    ping_interval = 30.0  # seconds of silence before a client is pinged
+    timeout = 75.0  # seconds of silence before a heartbeat client is evicted
+    resolution = 1.0  # seconds between two checks of the heap
+    _deadlines: list[tuple[float, int, "BaseServiceClient"]] = []
+    _counter = itertools.count()
+    pings = 0
+    evicted = 0
+
+    @classmethod
+    def watch(cls, client: "BaseServiceClient"):
+        if cls.ping_interval > 0 and client.client_info.heartbeat:
+            cls._push(client.last_seen + cls.ping_interval, client)
+
+    @classmethod
+    def _push(cls, deadline: float, client: "BaseServiceClient"):
+        heapq.heappush(cls._deadlines, (deadline, next(cls._counter), client))
+
+    @classmethod
+    def check(cls, now: float = None) -> int:
+        """
+        Handle the clients whose deadline passed: ping the idle ones, evict the silent ones in one go
+        :return: the number of evicted clients
+        """
+        if now is None:
+            now = time.monotonic()
+        ping = None
+        stale = []
+        while cls._deadlines and cls._deadlines[0][0] <= now:
+            _, _, client = heapq.heappop(cls._deadlines)
+            if client.close_code is not None or client.cid not in client.parent_plugin.clients:
+                continue  # gone since, its entry was left behind
+            idle = now - client.last_seen
+            if idle >= cls.timeout:
+                stale.append(client)
+            elif idle >= cls.ping_interval:
+                if ping is None:
+                    ping = Frame(PingEvent(timestamp=time.time()))
+                client.offer(ping)
+                cls.pings += 1
+                cls._push(client.last_seen + max(cls.timeout, idle + cls.ping_interval), client)
+            else:
+                cls._push(client.last_seen + cls.ping_interval, client)
+        for client in stale:
+            client.abort(1001, 'Ping timeout')
+        if stale:
+            cls.evicted += len(stale)
+            logger.info("Evicted {count} clients not answering pings", count=len(stale))
+        return len(stale)
+
+    @classmethod
+    async def scheduler(cls):
+        async def check_periodically():
+            while True:
+                await asyncio.sleep(cls.resolution)
+                cls.check()
+
+        task = asyncio.create_task(check_periodically())
+        yield
+        task.cancel()
+
+    @classmethod
+    def stats(cls) -> dict[str, int]:
+        return {
+            'watched': len(cls._deadlines),
+            'pings': cls.pings,
+            'evicted': cls.evicted,
+        }
@@ -0,0 +1,244 @@
+import asyncio
+import base64
+import collections
+import itertools
+import pathlib
+import time
+import uuid
+from typing import Optional, Sequence, TYPE_CHECKING
+
+from log import logger
+from storage import encode, decode
+from .journal import Journal
+from .structures import UpEvent
+
+if TYPE_CHECKING:
+    from .manager import PluginService
+
+
+class IngestQueue:
+    """
+    Bounded in-process queue between the report endpoints and the handlers
+
+    Reports are acknowledged once queued, a pool of drainer tasks hands them to the handlers in micro-batches
+    of up to ``batch_size`` reports, grouped by plugin. A full queue rejects the reports instead of growing.
+
+    When ``durable``, every queued report is written to a write-ahead log before it is acknowledged, and the
+    ids of delivered ones are appended after delivery. The reports left undelivered by a crash are queued
+    again at the next start, the log is truncated whenever the queue runs empty.
+    The log is group-committed by a single task on a thread: the records of the offers and acks that come in
+    while a write is running go together in the next write, with one fsync.
+    """
+    enabled = False
+    maxsize = 10000  # reports queued at most
+    drainers = 4
+    batch_size = 256  # reports handed to the handlers at once
+    durable = False
+    wal = Journal(pathlib.Path('./ingest.wal'), fsync=True)
+    _items: collections.deque[tuple[int, "PluginService", UpEvent, float]] = collections.deque()
+    _ready: Optional[asyncio.Event] = None
+    _tasks: list[asyncio.Task] = []
+    _closing = False
+    _ids = itertools.count()
+    _records: list[dict] = []  # write-ahead log records of the next commit
+    _waiters: list[asyncio.Future] = []  # offers waiting for the next commit
+    _committer: Optional[asyncio.Task] = None
+    _reserved = 0  # room taken by the offers being committed
+    in_flight = 0
+    enqueued = 0
+    delivered = 0
+    rejected = 0
+    failed = 0
+    delivery_lag = 0.0  # seconds from queued to delivered, of the last batch's oldest report
+
+    @classmethod
+    def configure(cls, enabled: bool = None, maxsize: int = None, drainers: int = None, batch_size: int = None,
+                  durable: bool = None):
+        cls.enabled = enabled or cls.enabled
+        cls.maxsize = maxsize or cls.maxsize
+        cls.drainers = drainers or cls.drainers
+        cls.batch_size = batch_size or cls.batch_size
+        cls.durable = durable or cls.durable
+
+    @classmethod
+    async def offer(cls, plugin: "PluginService", events: Sequence[UpEvent]) -> bool:
+        """
+        Queue the events of a plugin, all of them or none, once they are in the write-ahead log when durable
+        :return: False when the queue has no room for them
+        """
+        if len(cls._items) + cls._reserved + len(events) > cls.maxsize:
+            cls.rejected += len(events)
+            return False
+        now = time.monotonic()
+        items = [(next(cls._ids), plugin, event, now) for event in events]
+        if cls.durable:
+            cls._reserved += len(items)
+            try:
+                await cls._commit([{
+                    'id': item_id,
+                    'sid': str(plugin.sid),
+                    'event': base64.b64encode(encode(event)).decode(),
+                } for item_id, plugin, event, _ in items])
+            finally:
+                cls._reserved -= len(items)
+        cls._push(items)
+        return True
+
+    @classmethod
+    async def _commit(cls, records: list[dict]):
+        """
+        Write records to the write-ahead log with the next commit
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        cls._waiters.append(waiter)
+        cls._log(records)
+        await waiter
+
+    @classmethod
+    def _log(cls, records: list[dict]):
+        """
+        Add records to the next commit, without waiting for it
+        """
+        cls._records.extend(records)
+        if cls._committer is None:
+            cls._committer = asyncio.create_task(cls._commit_pending())
+
+    @classmethod
+    async def _commit_pending(cls):
+        while cls._records:
+            records, waiters = cls._records, cls._waiters
+            cls._records, cls._waiters = [], []
+            try:
+                await asyncio.to_thread(cls.wal.extend, records)
+            except Exception as e:
+                logger.opt(exception=e).error("Cannot write {count} records to the write-ahead log",
+                                              count=len(records))
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_exception(e)
+                continue
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+            if not cls._items and not cls.in_flight and not cls._reserved and not cls._records:
+                await asyncio.to_thread(cls.wal.truncate)  # every report written is delivered
+        cls._committer = None
+
+    @classmethod
+    def _push(cls, items: list[tuple[int, "PluginService", UpEvent, float]]):
+        cls._items.extend(items)
+        cls.enqueued += len(items)
+        if cls._ready is not None:
+            cls._ready.set()
+
+    @classmethod
+    def _recover(cls):
+        """
+        Queue again the reports of the write-ahead log that were not delivered
+        """
+        from .manager import PluginService
+
+        pending: dict[int, dict] = {}
+        last_id = -1
+        for record in cls.wal.replay():
+            if 'ack' in record:
+                for item_id in record['ack']:
+                    pending.pop(item_id, None)
+            else:
+                pending[record['id']] = record
+                last_id = max(last_id, record['id'])
+        if not pending:
+            cls.wal.truncate()
+            return
+        # the log is kept until they are delivered again, new ids must not collide with theirs
+        cls._ids = itertools.count(last_id + 1)
+        now = time.monotonic()
+        items = []
+        for record in pending.values():
+            plugin = PluginService.locate(sid=uuid.UUID(record['sid']))
+            if plugin is not None:
+                items.append((record['id'], plugin, decode(base64.b64decode(record['event'])), now))
+        cls._push(items)
+        lost = len(pending) - len(items)
+        if lost:
+            recovered = {item_id for item_id, *_ in items}
+            cls.wal.append({'ack': [item_id for item_id in pending if item_id not in recovered]})
+        logger.info("Recovered {count} undelivered reports ({lost} of unknown plugins dropped)",
+                    count=len(items), lost=lost)
+
+    @classmethod
+    def _take(cls) -> list[tuple[int, "PluginService", UpEvent, float]]:
+        count = min(len(cls._items), cls.batch_size)
+        return [cls._items.popleft() for _ in range(count)]
+
+    @classmethod
+    async def _drain(cls):
+        while True:
+            if not cls._items:
+                if cls._closing:
+                    return
+                cls._ready.clear()
+                await cls._ready.wait()
+                continue
+            batch = cls._take()
+            cls.in_flight += len(batch)
+            try:
+                await cls._deliver(batch)
+            finally:
+                cls.in_flight -= len(batch)
+            if cls.durable:
+                # not waited for, a lost ack only delivers the reports again after a crash
+                cls._log([{'ack': [item_id for item_id, *_ in batch]}])
+
+    @classmethod
+    async def _deliver(cls, batch: list[tuple[int, "PluginService", UpEvent, float]]):
+        cls.delivery_lag = time.monotonic() - batch[0][3]
+        grouped: dict["PluginService", list[UpEvent]] = {}
+        for _, plugin, event, _ in batch:
+            grouped.setdefault(plugin, []).append(event)
+        for plugin, events in grouped.items():
+            try:
+                await plugin.raise_events(events)
+                cls.delivered += len(events)
+            except Exception as e:
+                cls.failed += len(events)
+                logger.exception("Failed to deliver {count} reports of {plugin}: {e}",
+                                 count=len(events), plugin=plugin, e=e)
+
+    @classmethod
+    async def start(cls):
+        if not cls.enabled:
+            return
+        cls._ready = asyncio.Event()
+        cls._closing = False
+        if cls.durable:
+            cls._recover()
+        cls._tasks = [asyncio.create_task(cls._drain()) for _ in range(cls.drainers)]
+
+    @classmethod
+    async def stop(cls):
+        """
+        Deliver the reports already acknowledged, then stop the drainers
+        """
+        if cls._ready is None:
+            return
+        cls._closing = True
+        cls._ready.set()
+        await asyncio.gather(*cls._tasks)
+        cls._tasks = []
+        if cls._committer is not None:
+            await cls._committer
+        cls._ready = None
+
+    @classmethod
+    def stats(cls) -> dict[str, int | float]:
+        return {
+            'depth': len(cls._items),
+            'in_flight': cls.in_flight,
+            'lag': time.monotonic() - cls._items[0][3] if cls._items else 0.0,
+            'delivery_lag': cls.delivery_lag,
+            'enqueued': cls.enqueued,
+            'delivered': cls.delivered,
+            'rejected': cls.rejected,
+            'failed': cls.failed,
+        }
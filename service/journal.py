@@ -0,0 +1,68 @@
+import os
+import pathlib
+from json import JSONDecodeError
+from typing import IO, Iterable, Iterator, Optional
+
+from quart import json
+
+from log import logger
+
+
+class Journal:
+    """
+    Append-only journal of small JSON records, one per line
+
+    It is meant to sit next to a snapshot: mutations are appended here at a constant cost, and compaction
+    writes a new snapshot and then ``truncate`` the journal.
+    """
+
+    def __init__(self, path: pathlib.Path, fsync: bool = False):
+        self.path = path
+        self.fsync = fsync
+        self.records = 0
+        self._fp: Optional[IO[bytes]] = None
+
+    def append(self, record: dict):
+        self.extend((record,))
+
+    def extend(self, records: Iterable[dict]):
+        """
+        Append several records with a single write, and a single fsync
+        """
+        data = b''.join((json.dumps(record, ensure_ascii=False) + '\n').encode('u8') for record in records)
+        if not data:
+            return
+        if self._fp is None:
+            self._fp = self.path.open('ab')
+        self._fp.write(data)
+        self._fp.flush()
+        if self.fsync:
+            os.fsync(self._fp.fileno())
+        self.records += data.count(b'\n')
+
+    def replay(self) -> Iterator[dict]:
+        self.records = 0
+        if not self.path.is_file():
+            return
+        with self.path.open('r', encoding='u8') as fp:
+            for lineno, line in enumerate(fp, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except JSONDecodeError:
+                    # a torn write at the tail, left by a crash
+                    logger.warning("Skip broken journal record {path}:{lineno}", path=self.path, lineno=lineno)
+                    continue
+                self.records += 1
+                yield record
+
+    def truncate(self):
+        self.close()
+        self.path.unlink(True)
+        self.records = 0
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
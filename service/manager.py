@@ -1,196 +1,683 @@
 import asyncio
+import collections
 import copy
 import datetime
+import os
 import pathlib
 import pickle
+import time
 import uuid
+from abc import ABC, abstractmethod
 from asyncio import CancelledError
-from dataclasses import asdict, is_dataclass
-from typing import Any, Optional, Self
+from dataclasses import asdict
+from typing import Any, Iterable, Optional, Self, Sequence
 
 from quart import Websocket, json
 
 from log import logger
+from storage import SqliteStorage, encode
+from .bus import Bus
+from .codecs import CODECS, Codec
+from .crashes import Crashes
+from .eventstore import EventStore, event_columns
 from .exceptions import PluginNotFoundError, InvalidPluginError
+from .fanout import DownQueue
+from .frames import Frame
+from .heartbeat import Heartbeat
+from .journal import Journal
+from .reportlog import ReportLog
 from .structures import *
+from .validation import validate
+from .versions import VersionPredicate
 
 
 class FileReportHandler(ReportHandler):
     async def emit(self, plugin: "PluginService", report: ReportEvent):
-        path = pathlib.Path(f'./{report.sid}_report.json')
+        await self.emit_batch(plugin, [report])
+
+    async def emit_batch(self, plugin: "PluginService", reports: list[ReportEvent]):
+        path = pathlib.Path(f'./{reports[0].sid}_report.json')
         if not path.is_file():
             with path.open('w') as fp:
                 fp.write('[]')
         with path.open('r', encoding='u8') as frp:
             tmp = json.load(frp)
             with path.open('w', encoding='u8') as fwp:
-                tmp.append(
-                    asdict(report)
+                tmp.extend(
+                    asdict(report) for report in reports
                 )
                 json.dump(tmp, fwp, ensure_ascii=False)
 
 
-class ServiceClient:
-    def __init__(self, cid: uuid.UUID, parent: "PluginService" = None, client_info: ClientInfo = None, queue_max=50):
+class LogReportHandler(ReportHandler):
+    inline = True  # records are only buffered, the log writes them from a thread
+
+    async def emit(self, plugin: "PluginService", report: ReportEvent):
+        ReportLog.of(report.sid).append(asdict(report))
+
+    async def emit_batch(self, plugin: "PluginService", reports: list[ReportEvent]):
+        for report in reports:
+            ReportLog.of(report.sid).append(asdict(report))
+
+
+class BaseServiceClient(ABC):
+    """
+    What the connection engines share: client identity, the greeting, parsing of upstream events and
+    non-blocking delivery of down events
+    """
+    __slots__ = ()
+    cid: uuid.UUID
+    parent_plugin: "PluginService"
+    client_info: ClientInfo
+    codec: Codec
+    down_pending_event: DownQueue
+    task: Optional[asyncio.Task]
+    close_code: Optional[int]
+    close_reason: str
+    last_seen: float  # time.monotonic() of the last frame received
+    resumed: Optional[bool]  # whether all the events missed by the previous connection are replayed
+
+    def _init_client(self, cid: uuid.UUID, parent: "PluginService", client_info: Optional[ClientInfo],
+                     queue_max: int, overflow: Optional[OverflowPolicy]):
         self.cid = cid
-        self.parent_plugin: Optional["PluginService"] = parent
+        self.parent_plugin = parent
         if not client_info:
-            client_info = ClientInfo(**asdict(self.parent_plugin.plugin_info))
-        (client_info.name, client_info.sid) = \
-            self.parent_plugin.plugin_info.name, self.parent_plugin.plugin_info.sid
+            client_info = ClientInfo(**asdict(parent.plugin_info))
+        (client_info.name, client_info.sid) = parent.plugin_info.name, parent.plugin_info.sid
         self.client_info = client_info
-        self.count = 0
-        self.up_pending_event: asyncio.Queue[UpEvent] = asyncio.Queue(queue_max)
-        self.down_pending_event: asyncio.Queue[DownEvent] = asyncio.Queue(queue_max)
-        self.blocker: Optional[asyncio.Barrier] = None
+        self.codec = CODECS[client_info.encoding]
+        self.down_pending_event = DownQueue(queue_max, overflow or client_info.overflow or parent.overflow_policy)
+        self.task = None
+        self.close_code = None
+        self.close_reason = ''
+        self.last_seen = time.monotonic()
+        self.resumed = None
+
+    def greeting(self) -> str:
+        greeting = self.parent_plugin.greeting(self.cid, self.resumed)
+        if self.codec.binary:
+            # tell the client the frames after this one are binary
+            greeting = f'{greeting[:-1]}, "encoding": "{self.codec.name}"}}'
+        return greeting
+
+    def parse_event(self, event_data: dict) -> UpEvent:
+        event_type = event_data.pop('type')
+        event_data.setdefault('cid', self.cid)
+        event_data['sid'] = self.parent_plugin.sid
+        return validate(event_mapping[event_type], event_data)
+
+    def read_frame(self, data: str | bytes) -> UpEvent | list[UpEvent] | None:
+        """
+        Decode and parse an uplink frame, a frame that cannot be decoded is rejected like an invalid event
+        """
+        try:
+            frame_data = self.codec.decode(data)
+        except self.codec.errors as e:
+            self._acknowledge(1, [{'index': 0, 'message': f'{e.__class__.__name__}: {e}'}])
+            return None
+        return self.parse_frame(frame_data)
+
+    def parse_frame(self, frame_data: dict | list) -> UpEvent | list[UpEvent] | None:
+        """
+        Parse an uplink frame, either a single event or an array of events
+
+        Invalid events are skipped instead of failing the frame or the connection, and acknowledged to the
+        client when it asked for it. A pong or an invalid single event gives None.
+        """
+        if not isinstance(frame_data, list):
+            if isinstance(frame_data, dict) and frame_data.get('type') == UpEventType.pong:
+                return None  # only refreshes last_seen
+            try:
+                return self.parse_event(frame_data)
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                self._acknowledge(1, [{'index': 0, 'message': f'{e.__class__.__name__}: {e}'}])
+                return None
+        events = []
+        errors = []
+        for index, event_data in enumerate(frame_data):
+            try:
+                events.append(self.parse_event(event_data))
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                errors.append({'index': index, 'message': f'{e.__class__.__name__}: {e}'})
+        self._acknowledge(len(frame_data), errors)
+        return events
+
+    def _acknowledge(self, count: int, errors: list[dict]):
+        """
+        Count the rejected events of a frame and send its AckEvent, if the client asked for acks
+        """
+        if errors:
+            self.parent_plugin.rejected_events += len(errors)
+            logger.debug("Rejected {rejected}/{count} events of {client}: {message}", rejected=len(errors),
+                         count=count, client=self.cid, message=errors[0]['message'])
+        if self.client_info.batchAck:
+            self.offer(AckEvent(count=count, accepted=count - len(errors), errors=errors))
+
+    def offer(self, event: DownEvent | Frame) -> bool:
+        """
+        Deliver a down event to this client without waiting, the overflow policy applies when it lags behind
+        :param event: the event, or its frame when it is sent to several clients
+        :return: False if the client got disconnected instead
+        """
+        if self.close_code is not None:
+            return False
+        queue = self.down_pending_event
+        dropped = queue.dropped
+        accepted = queue.offer(event if isinstance(event, Frame) else Frame(event))
+        self.parent_plugin.dropped_events += queue.dropped - dropped
+        if not accepted:
+            self.parent_plugin.slow_disconnects += 1
+            self.abort(1008, 'Slow consumer')
+        return accepted
+
+    def abort(self, code: int = 1000, reason: str = ''):
+        """
+        Stop processing this connection and close the websocket with the given code
+        """
+        if self.close_code is None:
+            self.close_code, self.close_reason = code, reason
+            if self.task is not None:
+                self.task.cancel()
+
+    async def _closed(self, websocket: Websocket):
+        """
+        Called on cancellation of the connection task: close the websocket if the cancellation came from ``abort``
+        """
+        if self.close_code is None:
+            raise CancelledError
+        await websocket.close(self.close_code, self.close_reason)
+
+    @abstractmethod
+    async def process(self, websocket: Websocket):
+        """
+        Serve the connection until it is closed
+        """
+
+
+class ServiceClient(BaseServiceClient):
+    def __init__(self, cid: uuid.UUID, parent: "PluginService" = None, client_info: ClientInfo = None, queue_max=50,
+                 overflow: OverflowPolicy = None):
+        self._init_client(cid, parent, client_info, queue_max, overflow)
+        self.up_pending_event: asyncio.Queue[UpEvent | list[UpEvent]] = asyncio.Queue(queue_max)
 
     async def event_raise(self):
         while True:
-            if self.blocker is not None:
-                await self.blocker.wait()
-                return
             event = await self.up_pending_event.get()
-            if not isinstance(event, ClosedEvent):
+            if isinstance(event, ClosedEvent):
+                return
+            if isinstance(event, list):
+                await self.parent_plugin.raise_events(event)
+            else:
                 await self.parent_plugin.raise_event(event)
 
-    def add_processor(self):
-        self.count += 1
-
     async def process(self, websocket: Websocket):
-        tasks = (
-            asyncio.create_task(self.send(websocket)),
-            asyncio.create_task(self.receive(websocket)),
-            asyncio.create_task(self.event_raise())
-        )
-
-        await asyncio.gather(*tasks)
+        self.task = asyncio.current_task()
+        tasks = ()
+        try:
+            # before the sender starts, so the greeting comes first
+            await websocket.send(self.greeting())
+            tasks = (
+                asyncio.create_task(self.send(websocket)),
+                asyncio.create_task(self.receive(websocket)),
+                asyncio.create_task(self.event_raise())
+            )
+            await asyncio.gather(*tasks)
+        except CancelledError:
+            await self._closed(websocket)
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.parent_plugin.remove_client(self.cid, self)
 
     async def close(self):
-        await self.down_pending_event.put(DisconnectEvent())
+        self.down_pending_event.put_nowait(DisconnectEvent())
         await self.up_pending_event.put(ClosedEvent())
-        self.blocker = asyncio.Barrier(self.count + 1)
-        await self.blocker.wait()
-        self.parent_plugin.clients.pop(self.cid)
+        self.parent_plugin.remove_client(self.cid, self)
 
     async def receive(self, websocket: Websocket):
-        self.add_processor()
-        await websocket.send_json(asdict(
-            StatusEvent(
-                sid=str(self.client_info.sid),
-                cid=str(self.cid),
-                name=str(self.client_info.name),
-                message="Connected to server"
-            )
-        ))
-
-        try:
-            while True:
-                if self.blocker is not None:
-                    await self.blocker.wait()
-                    return
-                event_data: dict = await websocket.receive_json()
-                event_type = event_data['type']
-                event_data.pop('type')
-                event_data.setdefault('cid', self.cid)
-                event = event_mapping[event_type](sid=self.parent_plugin.sid, **event_data)
-
+        while True:
+            data = await websocket.receive()
+            self.last_seen = time.monotonic()
+            event = self.read_frame(data)
+            if event is not None:
                 await self.up_pending_event.put(event)
-        except CancelledError:
-            await self.close()
-            if self.blocker is not None:
-                await self.blocker.wait()
-            raise
 
     async def send(self, websocket: Websocket):
-        self.add_processor()
         while True:
-            event: DownEvent = await self.down_pending_event.get()
-            if isinstance(event, DisconnectEvent):
-                await self.blocker.wait()
+            frame: Frame | DisconnectEvent = await self.down_pending_event.get()
+            if isinstance(frame, DisconnectEvent):
                 return
-            if isinstance(event, DownEvent) and is_dataclass(event):
-                await websocket.send_json(asdict(event))
+            await websocket.send(frame.encoded(self.codec))
+
+
+class LeanServiceClient(BaseServiceClient):
+    """
+    Connection engine running a single task per connection
+
+    The connection task reads frames and dispatches upstream events straight to the plugin. Down events are
+    written by a short-lived writer task that only exists while there are events pending.
+    """
+    __slots__ = ('cid', 'parent_plugin', 'client_info', 'codec', 'down_pending_event', 'task', 'close_code',
+                 'close_reason', 'last_seen', 'resumed', 'websocket', 'writer')
+
+    def __init__(self, cid: uuid.UUID, parent: "PluginService" = None, client_info: ClientInfo = None, queue_max=50,
+                 overflow: OverflowPolicy = None):
+        self._init_client(cid, parent, client_info, queue_max, overflow)
+        self.websocket: Optional[Websocket] = None
+        self.writer: Optional[asyncio.Task] = None
+
+    async def process(self, websocket: Websocket):
+        self.task = asyncio.current_task()
+        try:
+            await websocket.send(self.greeting())
+            # keep the websocket itself, the writer task may run outside its context
+            self.websocket = getattr(websocket, '_get_current_object', lambda: websocket)()
+            if self.down_pending_event and self.writer is None:
+                # events queued during the greeting, replayed ones first
+                self.writer = asyncio.create_task(self._write())
+            while True:
+                data = await self.websocket.receive()
+                self.last_seen = time.monotonic()
+                event = self.read_frame(data)
+                if event is None:
+                    continue
+                if isinstance(event, list):
+                    await self.parent_plugin.raise_events(event)
+                else:
+                    await self.parent_plugin.raise_event(event)
+        except CancelledError:
+            await self._closed(websocket)
+        finally:
+            if self.writer is not None:
+                self.writer.cancel()
+            self.parent_plugin.remove_client(self.cid, self)
+
+    def offer(self, event: DownEvent | Frame) -> bool:
+        accepted = super().offer(event)
+        if accepted and self.writer is None and self.websocket is not None:
+            self.writer = asyncio.create_task(self._write())
+        return accepted
+
+    async def _write(self):
+        try:
+            while self.down_pending_event:
+                await self.websocket.send(self.down_pending_event.popleft().encoded(self.codec))
+        except Exception as e:
+            # nobody awaits the writer, the reader sees the connection drop and removes the client
+            logger.debug("Cannot write to {cid} of {plugin}: {e}", cid=self.cid, plugin=self.parent_plugin, e=e)
+        finally:
+            self.writer = None
+
+
+CLIENT_ENGINES: dict[str, type[BaseServiceClient]] = {
+    'tasks': ServiceClient,
+    'single': LeanServiceClient,
+}
 
 
 class PluginService:
     _inited = False
     storage_path = pathlib.Path('./services.dat')
+    journal = Journal(pathlib.Path('./services.journal'))
+    compact_interval = 300  # seconds between folding the journal into the snapshot
     services: dict[uuid.UUID, Self] = {}
+    names: dict[str, uuid.UUID] = {}
     max_pending_size = 50
-
-    def __new__(cls, sid: uuid.UUID = None, name: str = None,
-                handlers: list[Handler] = None, _sid: uuid.UUID = None, _inited=False, create=False):
-        if not sid and _sid:
-            sid = _sid
-        if _inited:
-            obj = object.__new__(cls)
-            obj._inited = True
-            return obj
-        if sid and sid in cls.services:
-            obj = cls.services[sid]
-            obj._inited = True
-            return obj
-        for sid in cls.services:
-            if cls.services[sid].name == name:
-                obj = cls.services[sid]
-                obj._inited = True
-                return obj
-        import inspect
-        frame = inspect.currentframe()
-        if create or (frame and frame.f_back.f_code.co_filename == frame.f_code.co_filename):
-            obj = object.__new__(cls)
-            obj._sid = sid or uuid.uuid4()
-            return obj
-        else:
-            raise PluginNotFoundError(f"Cannot find PluginService for "
-                                      f"{name if name else 'unknown'}({sid if sid else 'unknown sid'})")
-
-    def __init__(self, sid: uuid.UUID = None, name: str = None, handlers: list[Handler] = None):
+    client_class: type[BaseServiceClient] = ServiceClient
+    replay_size = 256  # down events kept for the clients resuming their connection
+    overflow_policy = OverflowPolicy.drop_oldest  # for clients not asking for another one
+    bus: Bus = Bus()  # reaches the services of the other workers
+    primary = True  # only the primary worker writes snapshots when several workers share the storage
+    worker = '0'  # keys the rows of this worker in the storage, see ``all_crashes``
+    resync_interval = 30  # seconds between two reloads of the registry from the storage
+    storage: Optional[SqliteStorage] = None  # replaces the snapshot and the journal when set
+    flush_window = 0.2  # seconds, storage writes made within it are batched
+    _dirty: set[uuid.UUID] = set()  # services changed since the last storage flush
+    _changed = False  # services changed since the last snapshot, the journal only has the registry
+    _pending_events: list[tuple] = []  # rows of the events table, see SqliteStorage.append_events
+    _flush_handle: Optional[asyncio.TimerHandle] = None
+    _flushes: set[asyncio.Task] = set()
+    _registry_changes = 0  # registrations and renames made by this worker
+
+    def __new__(cls, sid: uuid.UUID = None, name: str = None, handlers: list[Handler] = None, create=False):
+        if sid is None and name is None:
+            # unpickling, the state is restored by __setstate__
+            return object.__new__(cls)
+        if not create:
+            return cls.get(sid, name)
+        service = cls.locate(sid, name)
+        if service is not None:
+            return service
+        obj = object.__new__(cls)
+        obj._sid = sid or uuid.uuid4()
+        return obj
+
+    def __init__(self, sid: uuid.UUID = None, name: str = None, handlers: list[Handler] = None, create=False):
         if not (sid or hasattr(self, "_sid")):
             raise InvalidPluginError(f'Invalid {self.__class__}')
-        if hasattr(self, "_inited") and self._inited:
+        if self._inited:
             return
         self._inited = True
-        self._sid = sid
+        sid = self._sid
         self.create_date = datetime.datetime.utcnow()
         self.name = name
         self.plugin_info = PluginInfo(self.sid, self.name)
         if not handlers:
-            handlers = [FileReportHandler()]
+            handlers = [LogReportHandler()]
         self.handlers: list[Handler] = handlers
-        self.clients: dict[uuid.UUID, ServiceClient] = {}
+        self._dispatch: dict[str, list[Handler]] = self._build_dispatch()
+        self.handler_errors = 0
+        self.handler_timeouts = 0
+        self.clients: dict[uuid.UUID, BaseServiceClient] = {}
+        self.versions: dict[Optional[str], set[uuid.UUID]] = {}  # ClientInfo.version: cids of the clients
+        self.dropped_events = 0
+        self.slow_disconnects = 0
+        self.rejected_events = 0  # invalid events of the websocket clients
+        self._greeting_head: Optional[str] = None
+        self.seq = 0  # of the last event sent to all the clients
+        self.replay_log: collections.deque[Frame] = collections.deque(maxlen=self.replay_size)
         self.__class__.services[sid] = self
-        self.events: list[UpEvent] = []
+        if name is not None:
+            self.__class__.names[name] = sid
+        self.events = EventStore(sid)
+        self.crashes = Crashes()
+
+    @classmethod
+    def locate(cls, sid: uuid.UUID = None, name: str = None) -> Optional[Self]:
+        """
+        Find a registered PluginService by sid, then by name
+        :return: the PluginService or None if neither matches
+        """
+        if sid is not None:
+            service = cls.services.get(sid)
+            if service is not None:
+                return service
+        if name is not None:
+            sid = cls.names.get(name)
+            if sid is not None:
+                return cls.services.get(sid)
+        return None
 
-    def add_client(self, cid: uuid.UUID = None, client_info: ClientInfo = None, queue_max=50):
+    @classmethod
+    def get(cls, sid: uuid.UUID = None, name: str = None) -> Self:
+        service = cls.locate(sid, name)
+        if service is None:
+            raise PluginNotFoundError(f"Cannot find PluginService for "
+                                      f"{name if name else 'unknown'}({sid if sid else 'unknown sid'})")
+        return service
+
+    def rename(self, name: str):
+        if name == self.name:
+            return
+        if name in self.names:
+            raise InvalidPluginError(f'Name {name} is already used by PluginService({self.names[name]})')
+        if self.name is not None:
+            self.names.pop(self.name, None)
+        self.name = self.plugin_info.name = name
+        self.names[name] = self.sid
+        self._greeting_head = None
+        self.__class__._registry_changes += 1
+        record = {'op': 'rename', 'sid': self.sid, 'name': name}
+        if self.storage is None:
+            self.journal.append(record)
+        else:
+            self.mark_dirty(self.sid)
+        self.bus.publish(record)
+
+    def add_client(self, cid: uuid.UUID = None, client_info: ClientInfo = None, queue_max=50,
+                   overflow: OverflowPolicy = None):
+        """
+        Create a client, it resumes the previous connection when ``client_info`` carries its cid and last sequence
+        """
         if not cid:
-            cid = uuid.uuid4()
-        self.clients[cid] = ServiceClient(cid, self, client_info, queue_max)
-        return self.clients[cid]
+            cid = client_info.cid if client_info is not None and client_info.cid else uuid.uuid4()
+        previous = self.clients.get(cid)
+        if previous is not None:
+            # most likely the half-open connection the client comes back from
+            previous.abort(1000, 'Resumed by another connection')
+            self._unindex(previous)
+        client = self.clients[cid] = self.client_class(cid, self, client_info, queue_max, overflow)
+        self.versions.setdefault(client.client_info.version, set()).add(cid)
+        if client_info is not None and client_info.lastSeq is not None:
+            client.resumed, missed = self.missed(client_info.lastSeq)
+            for frame in missed:
+                client.down_pending_event.put_nowait(frame)
+        Heartbeat.watch(client)
+        return client
+
+    def remove_client(self, cid: uuid.UUID, client: BaseServiceClient = None):
+        """
+        :param client: only remove this one, not another connection that resumed it since
+        """
+        if client is None or self.clients.get(cid) is client:
+            client = self.clients.pop(cid, None)
+            if client is not None:
+                self._unindex(client)
+
+    def _unindex(self, client: BaseServiceClient):
+        cids = self.versions.get(client.client_info.version)
+        if cids is not None:
+            cids.discard(client.cid)
+            if not cids:
+                del self.versions[client.client_info.version]
+
+    def target(self, cids: Iterable[uuid.UUID] = None, version: str = None) -> list[BaseServiceClient]:
+        """
+        Look clients up through the indexes, every client when neither ``cids`` nor ``version`` is given
+        :param cids: the clients to address
+        :param version: a VersionPredicate the ClientInfo.version of the clients has to match
+        """
+        predicate = VersionPredicate(version) if version is not None else None
+        if cids is not None:
+            clients = [client for cid in cids if (client := self.clients.get(cid)) is not None]
+            if predicate is not None:
+                clients = [client for client in clients if predicate(client.client_info.version)]
+            return clients
+        if predicate is not None:
+            return [self.clients[cid]
+                    for client_version, version_cids in self.versions.items() if predicate(client_version)
+                    for cid in version_cids]
+        return list(self.clients.values())
+
+    def missed(self, last_seq: int) -> tuple[bool, list[Frame]]:
+        """
+        The events of the replay log sent after ``last_seq``
+        :return: whether nothing was missed beyond them, and the events
+        """
+        if last_seq > self.seq:
+            return False, []
+        missed = []
+        for frame in reversed(self.replay_log):
+            if frame.event.seq <= last_seq:
+                break
+            missed.append(frame)
+        missed.reverse()
+        return (missed[0].event.seq if missed else self.seq + 1) == last_seq + 1, missed
 
     def add_handler(self, handler: Handler):
         self.handlers.append(handler)
+        self._dispatch = self._build_dispatch()
+        self.__class__._changed = True
+
+    def _build_dispatch(self) -> dict[str, list[Handler]]:
+        """
+        The handlers of each event type, in the order they were added. Types of no known handler get the default
+        handlers, under the 'default' key
+        """
+        types = {'default', *GeneralEventType, *UpEventType, *(handler.type for handler in self.handlers)}
+        return {
+            event_type: [handler for handler in self.handlers if handler.type in (event_type, 'default')]
+            for event_type in types
+        }
 
-    # noinspection PyTypeChecker
     async def raise_event(self, event: UpEvent):
-        tasks = []
-
-        self.events.append(event)
+        await self.raise_events((event,))
+
+    async def raise_events(self, events: Sequence[UpEvent]):
+        """
+        Store events and dispatch them to the handlers, each handler gets its events in one ``emit_batch`` call.
+        Inline handlers are awaited in place, the others together, each within its timeout. A failing handler is
+        logged and does not affect the others.
+        Repeated crash reports are folded into their aggregate instead, see ``Crashes``
+        """
+        events = self.crashes.fold(events)
+        if self.crashes.changed:
+            self.crashes.changed = False
+            if self.storage is not None:
+                self.mark_dirty(self.sid)  # the aggregates are saved with the service
+            else:
+                self.__class__._changed = True
+        if not events:
+            return
 
-        for handler in self.handlers:
-            if event.type == handler.type:
-                tasks.append(asyncio.create_task(handler.emit(self, event)))
-            elif handler.type == 'default':
-                tasks.append(asyncio.create_task(handler.emit(self, event)))
+        self.events.extend(events)
+        if self.storage is not None:
+            self._pending_events.extend((str(self.sid), *event_columns(event), encode(event)) for event in events)
+            self.schedule_flush()
+        else:
+            self.__class__._changed = True
 
-        await asyncio.gather(*tasks)
+        event_type = events[0].type if events else None
+        if all(event.type == event_type for event in events):
+            batches = {handler: events for handler in self._dispatch.get(event_type, self._dispatch['default'])}
+        else:
+            batches: dict[Handler, list[UpEvent]] = {}
+            for event in events:
+                for handler in self._dispatch.get(event.type, self._dispatch['default']):
+                    batches.setdefault(handler, []).append(event)
+
+        pending = []
+        for handler, matching in batches.items():
+            if handler.inline:
+                await self._emit(handler, matching)
+            else:
+                pending.append(self._emit(handler, matching))
+        if len(pending) == 1:
+            await pending[0]
+        elif pending:
+            await asyncio.gather(*pending)
+
+    async def _emit(self, handler: Handler, events: Sequence[UpEvent]):
+        try:
+            if handler.inline or handler.timeout is None:
+                await handler.emit_batch(self, events)
+            else:
+                await asyncio.wait_for(handler.emit_batch(self, events), handler.timeout)
+        except asyncio.TimeoutError:
+            self.handler_timeouts += 1
+            logger.warning("{handler} of {plugin} timed out on {count} events",
+                           handler=handler, plugin=self, count=len(events))
+        except Exception as e:
+            self.handler_errors += 1
+            logger.opt(exception=e).error("{handler} of {plugin} failed on {count} events",
+                                          handler=handler, plugin=self, count=len(events))
 
     async def broadcast(self, message: str, **kwargs):
-        for cid in self.clients:
-            await self.clients[cid].down_pending_event.put(BroadcastEvent(
+        frame = self.deliver(message, await self.next_seq(), **kwargs)
+        self.bus.publish({'op': 'broadcast', 'sid': self.sid, 'seq': frame.event.seq, 'message': message,
+                          'kwargs': kwargs})
+
+    async def next_seq(self) -> int:
+        """
+        Allocate the sequence number of a broadcast, in the storage when the workers share one
+        """
+        if self.storage is None:
+            return self.seq + 1
+        return await self.storage.run(self.storage.next_sequence, str(self.sid), self.seq + 1)
+
+    def deliver(self, message: str, seq: int = None, **kwargs) -> Frame:
+        """
+        Broadcast to the clients connected to this worker only
+        :param seq: allocated by ``next_seq`` of the worker the broadcast comes from, the next one otherwise
+        """
+        if seq is None:
+            seq = self.seq + 1
+        self.seq = max(self.seq, seq)
+        frame = Frame(BroadcastEvent(
+            message=message,
+            seq=seq,
+            **kwargs
+        ))
+        self._log_frame(frame)
+        for client in list(self.clients.values()):
+            client.offer(frame)
+        return frame
+
+    def _log_frame(self, frame: Frame):
+        """
+        Add a frame to the replay log in sequence order, the broadcasts of other workers may arrive late
+        """
+        log = self.replay_log
+        seq = frame.event.seq
+        if not log or log[-1].event.seq < seq:
+            log.append(frame)
+            return
+        i = len(log)
+        while i and log[i - 1].event.seq > seq:
+            i -= 1
+        if i and log[i - 1].event.seq == seq:
+            return  # already logged
+        if len(log) == log.maxlen:
+            if i == 0:
+                return  # older than the whole log
+            log.popleft()
+            i -= 1
+        log.insert(i, frame)
+
+    async def send(self, message: str, cids: Iterable[uuid.UUID] = None, version: str = None, **kwargs) -> int:
+        """
+        Broadcast to some clients only, see ``target``. Such events are not sequenced nor replayed.
+        :return: the number of clients of this worker the event was sent to
+        """
+        delivered = self.deliver_to(message, cids, version, **kwargs)
+        self.bus.publish({'op': 'send', 'sid': self.sid, 'cids': None if cids is None else list(cids),
+                          'version': version, 'message': message, 'kwargs': kwargs})
+        return delivered
+
+    def deliver_to(self, message: str, cids: Iterable[uuid.UUID] = None, version: str = None, **kwargs) -> int:
+        clients = self.target(cids, version)
+        if clients:
+            frame = Frame(BroadcastEvent(
                 message=message,
                 **kwargs
             ))
+            for client in clients:
+                client.offer(frame)
+        return len(clients)
+
+    def greeting(self, cid: uuid.UUID, resumed: Optional[bool] = None) -> str:
+        """
+        The encoded StatusEvent sent to a new client, only its cid and the sequence are encoded per client
+        :param resumed: for a resuming client, whether all the events it missed are replayed
+        """
+        if self._greeting_head is None:
+            status = asdict(StatusEvent(sid=str(self.sid), name=str(self.name), message="Connected to server"))
+            del status['cid'], status['seq']
+            self._greeting_head = json.dumps(status, ensure_ascii=False)[:-1]
+        tail = '' if resumed is None else f', "resumed": {"true" if resumed else "false"}'
+        return f'{self._greeting_head}, "cid": "{cid}", "seq": {self.seq}{tail}}}'
+
+    async def all_crashes(self) -> Crashes:
+        """
+        The crash aggregates of this plugin, with the ones of the other workers sharing the storage
+        """
+        if self.storage is None:
+            return self.crashes
+        rows = await self.storage.run(self.storage.load, 'crashes', f'{self.sid}/')
+        others = [crashes for key, crashes in rows.items() if key != f'{self.sid}/{self.worker}']
+        return Crashes.merged([self.crashes, *others]) if others else self.crashes
+
+    def metrics(self) -> dict[str, int]:
+        return {
+            'clients': len(self.clients),
+            'dropped_events': self.dropped_events,
+            'slow_disconnects': self.slow_disconnects,
+            'rejected_events': self.rejected_events,
+            'handler_errors': self.handler_errors,
+            'handler_timeouts': self.handler_timeouts,
+            'crash_fingerprints': len(self.crashes),
+            'folded_reports': self.crashes.folded,
+        }
 
     @property
     def sid(self):
@@ -209,18 +696,257 @@ class PluginService:
 
     @classmethod
     def load(cls):
-        if not cls.storage_path.is_file():
+        if cls.storage_path.is_file():
+            with cls.storage_path.open('rb') as fp:
+                cls.services = pickle.load(fp)
+        cls.names = {service.name: sid for sid, service in cls.services.items() if service.name is not None}
+        for record in cls.journal.replay():
+            cls._replay(record)
+        logger.debug("Services loaded: {services} ({records} journal records replayed)",
+                     services=cls.services, records=cls.journal.records)
+
+    @classmethod
+    def _replay(cls, record: dict):
+        sid = uuid.UUID(record['sid'])
+        if record['op'] == 'register':
+            if sid not in cls.services:
+                PluginService(name=record['name'], sid=sid, create=True)
+        elif record['op'] == 'rename':
+            service = cls.services.get(sid)
+            if service is not None and service.name != record['name']:
+                if service.name is not None:
+                    cls.names.pop(service.name, None)
+                service.name = service.plugin_info.name = record['name']
+                service._greeting_head = None
+                cls.names[service.name] = sid
+
+    @classmethod
+    def on_bus(cls, record: dict):
+        """
+        Apply a record published by another worker
+        """
+        if record['op'] == 'broadcast':
+            service = cls.services.get(uuid.UUID(record['sid']))
+            if service is not None:
+                service.deliver(record['message'], record.get('seq'), **record['kwargs'])
+        elif record['op'] == 'send':
+            service = cls.services.get(uuid.UUID(record['sid']))
+            if service is not None:
+                cids = None if record['cids'] is None else [uuid.UUID(cid) for cid in record['cids']]
+                service.deliver_to(record['message'], cids, record['version'], **record['kwargs'])
+        else:
+            cls._replay(record)
+
+    @classmethod
+    async def bus_connection(cls):
+        async def resync_periodically():
+            while True:
+                await asyncio.sleep(cls.resync_interval)
+                try:
+                    await cls.resync()
+                except Exception as e:
+                    logger.opt(exception=e).error("Cannot reload the services from the storage")
+
+        await cls.bus.start(cls.on_bus)
+        task = asyncio.create_task(resync_periodically()) if cls.storage is not None else None
+        yield
+        if task is not None:
+            task.cancel()
+        await cls.bus.close()
+
+    @classmethod
+    async def resync(cls):
+        """
+        Apply the registrations and renames of the other workers from the storage, the bus may have lost some
+        """
+        await cls.flush()
+        changes = cls._registry_changes
+        rows = await cls.storage.run(cls.storage.load, 'services')
+        if cls._registry_changes != changes:
+            return  # the rows may predate a change of this worker, the next resync applies them
+        for row in rows.values():
+            service = cls.services.get(row['sid'])
+            if service is None:
+                service = PluginService(row['sid'], row['name'], row['handlers'], create=True)
+                service.create_date = row['create_date']
+                service.events.max_events = row.get('max_events')
+                logger.info("{service} registered by another worker", service=service)
+            elif service.name != row['name'] and row['name'] is not None:
+                cls._replay({'op': 'rename', 'sid': str(service.sid), 'name': row['name']})
+
+    @classmethod
+    def use_storage(cls, storage: SqliteStorage):
+        """
+        Switch to the sqlite backend and load the services from it, the services loaded from the snapshot are
+        migrated on the first start. The events table is then the event history, nothing is loaded from it.
+        """
+        cls.storage = EventStore.storage = storage
+        filled = storage.backfill_events(event_columns)
+        if filled:
+            logger.info("Indexed {count} events stored before", count=filled)
+        rows = storage.load('services')
+        if not rows:
+            cls._dirty.update(cls.services)
+            for service in cls.services.values():
+                cls._pending_events.extend((str(service.sid), *event_columns(event), encode(event))
+                                           for event in service.events)
+            services, crashes, events = cls._take_pending()
+            # the workers start together, the first one migrates and the others load what it wrote
+            if storage.migrate({'services': services, 'crashes': crashes}, events):
+                for service in cls.services.values():
+                    # the history moved to the events table, the new store keeps nothing
+                    service.events = EventStore(service.sid, service.events.max_events)
+                return
+            rows = storage.load('services')
+        cls.services = {}
+        cls.names = {}
+        sequences = storage.sequences()
+        crashes = storage.load('crashes')
+        for row in rows.values():
+            service = PluginService(row['sid'], row['name'], row['handlers'], create=True)
+            service.create_date = row['create_date']
+            service.events.max_events = row.get('max_events')
+            # saved in the service row before, taken over by a single worker
+            service.crashes = crashes.get(f'{service.sid}/{cls.worker}') \
+                or (row.get('crashes') if cls.primary else None) or Crashes()
+            service.seq = sequences.get(str(service.sid), 0)
+        logger.debug("Services loaded from {path}: {services}", path=storage.path, services=cls.services)
+
+    @classmethod
+    def mark_dirty(cls, sid: uuid.UUID):
+        cls._dirty.add(sid)
+        cls.schedule_flush()
+
+    @classmethod
+    def schedule_flush(cls):
+        if cls._flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
             cls.save()
-        with cls.storage_path.open('rb') as fp:
-            cls.services = pickle.load(fp)
-        logger.debug("Services loaded: {services}", services=cls.services)
+            return
+        cls._flush_handle = loop.call_later(cls.flush_window, cls._flush)
+
+    @classmethod
+    def _take_pending(cls) -> tuple[dict[str, bytes], dict[str, bytes], list[tuple]]:
+        if cls._flush_handle is not None:
+            cls._flush_handle.cancel()
+            cls._flush_handle = None
+        services = [service for sid in cls._dirty if (service := cls.services.get(sid)) is not None]
+        rows = {str(service.sid): encode({
+            'sid': service.sid,
+            'name': service.name,
+            'create_date': service.create_date,
+            'handlers': service.handlers,
+            'max_events': service.events.max_events,
+        }) for service in services}
+        # the aggregates of each worker are rows of their own, merged by all_crashes
+        crashes = {f'{service.sid}/{cls.worker}': encode(service.crashes) for service in services}
+        events, cls._pending_events = cls._pending_events, []
+        cls._dirty = set()
+        return rows, crashes, events
+
+    @classmethod
+    def _write(cls, rows: dict[str, bytes], crashes: dict[str, bytes], events: list[tuple]):
+        if rows:
+            cls.storage.write('services', rows)
+        if crashes:
+            cls.storage.write('crashes', crashes)
+        if events:
+            cls.storage.append_events(events)
+
+    @classmethod
+    def _flush(cls):
+        task = asyncio.create_task(cls.storage.run(cls._write, *cls._take_pending()))
+        cls._flushes.add(task)
+        task.add_done_callback(cls._flushed)
+
+    @classmethod
+    def _flushed(cls, task: asyncio.Task):
+        cls._flushes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.opt(exception=task.exception()).error("Cannot write services to the storage")
+
+    @classmethod
+    async def flush(cls):
+        """
+        Write the pending rows and events to the storage on its threads, after the writes already running
+        """
+        if cls._flushes:
+            await asyncio.wait(list(cls._flushes))
+        await cls.storage.run(cls._write, *cls._take_pending())
 
     @classmethod
     def save(cls):
+        """
+        Write a snapshot of all services and fold the journal into it, or flush the pending writes to the storage
+        """
+        if cls.storage is not None:
+            cls._write(*cls._take_pending())
+            return
+        if not cls.primary:
+            # the primary worker has the same registry through the bus and owns the snapshot
+            return
         logger.info("Saving data...")
-        with cls.storage_path.open('wb') as fp:
-            logger.debug("Services to save: {services}", services=cls.services)
-            pickle.dump(cls.services, fp)
+        logger.debug("Services to save: {services}", services=cls.services)
+        cls._changed = False
+        cls._dump(cls.services)
+        cls.journal.truncate()
+
+    @classmethod
+    def _dump(cls, services: dict[uuid.UUID, Self]):
+        tmp_path = cls.storage_path.with_name(cls.storage_path.name + '.tmp')
+        with tmp_path.open('wb') as fp:
+            pickle.dump(services, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, cls.storage_path)
+
+    @classmethod
+    async def checkpoint(cls):
+        """
+        Write a snapshot without blocking the loop: the services are copied on the loop, which is cheap and
+        consistent, and pickled and written on a thread
+        """
+        if cls.storage is not None or not cls.primary:
+            return
+        records = cls.journal.records
+        cls._changed = False
+        services = {sid: service.copy() for sid, service in cls.services.items()}
+        try:
+            await asyncio.to_thread(cls._dump, services)
+        except Exception:
+            cls._changed = True
+            raise
+        # records appended meanwhile may not be in the snapshot, they are kept until the next one
+        if cls.journal.records == records:
+            cls.journal.truncate()
+
+    @classmethod
+    async def compaction(cls):
+        async def compact_periodically():
+            while True:
+                await asyncio.sleep(cls.compact_interval)
+                if cls._changed or cls.journal.records:
+                    try:
+                        await cls.checkpoint()
+                    except Exception as e:
+                        logger.opt(exception=e).error("Cannot write the services snapshot")
+
+        task = asyncio.create_task(compact_periodically())
+        yield
+        task.cancel()
+
+    @classmethod
+    def _journal_register(cls, service: Self):
+        record = {'op': 'register', 'sid': service.sid, 'name': service.name}
+        cls._registry_changes += 1
+        if cls.storage is None:
+            cls.journal.append(record)
+        else:
+            cls.mark_dirty(service.sid)
+        cls.bus.publish(record)
 
     @classmethod
     def register_with_name(cls, name: str = None, sid: uuid.UUID = None, handlers=None) -> Self:
@@ -228,29 +954,64 @@ class PluginService:
             handlers = []
         if not sid:
             sid = uuid.uuid4()
-        service = PluginService(name=name, sid=sid, handlers=handlers)
-        cls.save()
+        known = len(cls.services)
+        service = PluginService(name=name, sid=sid, handlers=handlers, create=True)
+        if len(cls.services) > known:
+            cls._journal_register(service)
         return service
 
     @classmethod
     def register(cls, sid: uuid.UUID, name: str = None, handlers=None) -> Self:
         if handlers is None:
             handlers = []
-        service = PluginService(name=name, sid=sid, handlers=handlers)
-        cls.save()
+        known = len(cls.services)
+        service = PluginService(name=name, sid=sid, handlers=handlers, create=True)
+        if len(cls.services) > known:
+            cls._journal_register(service)
         return service
 
+    def copy(self) -> Self:
+        """
+        A copy for the snapshot, of everything the loop goes on changing
+        """
+        clone = object.__new__(PluginService)
+        clone.__dict__.update(self.__getstate__())
+        clone.plugin_info = copy.copy(self.plugin_info)
+        clone.handlers = list(self.handlers)
+        clone.events = self.events.copy()
+        clone.crashes = self.crashes.copy()
+        return clone
+
     def __getstate__(self):
         instance_dict = copy.copy(self.__dict__)
         instance_dict['clients'] = {}
+        instance_dict['versions'] = {}
+        instance_dict.pop('replay_log', None)
+        instance_dict.pop('_dispatch', None)
         return instance_dict
 
     def __setstate__(self, state: dict[str, Any]):
-        state.setdefault('events', [])
+        events = state.get('events', [])
+        if not isinstance(events, EventStore):
+            state['events'] = EventStore(state['_sid'])
+            state['events'].extend(events)
         state.setdefault('_inited', True)
         state['clients'] = {}
+        state['versions'] = {}
+        state.setdefault('dropped_events', 0)
+        state.setdefault('slow_disconnects', 0)
+        state.setdefault('rejected_events', 0)
+        state['_greeting_head'] = None
+        state.setdefault('seq', 0)
+        state['replay_log'] = collections.deque(maxlen=self.replay_size)
+        state['handlers'] = [LogReportHandler() if isinstance(handler, FileReportHandler) else handler
+                             for handler in state.get('handlers', [])]
+        state.setdefault('handler_errors', 0)
+        state.setdefault('handler_timeouts', 0)
+        state.setdefault('crashes', Crashes())
         for key in state:
             self.__dict__[key] = state[key]
+        self._dispatch = self._build_dispatch()
         return state
 
 
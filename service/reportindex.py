@@ -0,0 +1,173 @@
+import bisect
+import datetime
+import itertools
+from array import array
+from typing import Optional
+
+from .structures import UpEvent, ReportEvent, ReportLevel, UpEventType
+
+LEVELS = tuple(ReportLevel)
+LEVEL_CODES = {level: code for code, level in enumerate(LEVELS)}
+
+
+def timestamp_of(value) -> float:
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.UTC)
+        return value.timestamp()
+    if isinstance(value, (int, float)):
+        return float(value)
+    return 0.0
+
+
+class ReportIndex:
+    """
+    Secondary indexes over the events of an EventStore
+
+    Every event is indexed by type. Report events are also stored column-wise (position, timestamp, level
+    and cid), each one identified by its ordinal among the reports, with posting lists by level and cid and a
+    timestamp-sorted index, which takes reports arriving out of order.
+
+    The index covers the latest ``max_reports`` reports and ``max_reports`` events of each type, so its memory
+    and its share of the snapshot stay bounded, older events are only reachable by position.
+    """
+    max_reports = 100_000
+
+    def __init__(self):
+        self.types: dict[str, array] = {}  # positions of the events of each type
+        self.base = 0  # ordinal of the first report indexed, the columns start with it
+        self.positions = array('Q')
+        self.timestamps = array('d')
+        self.levels = bytearray()
+        self.cids = array('l')
+        self.by_level: dict[int, array] = {}
+        self.by_cid: dict[int, array] = {}
+        self.cid_ids: dict[str, int] = {}
+        self.by_time = array('d')  # timestamps in order
+        self.by_time_ordinals = array('Q')  # ordinals of the reports in by_time
+
+    def add(self, position: int, event: UpEvent):
+        postings = self.types.setdefault(str(event.type), array('Q'))
+        postings.append(position)
+        if len(postings) > self.max_reports + self.max_reports // 4:
+            del postings[:len(postings) - self.max_reports]
+        if not isinstance(event, ReportEvent):
+            return
+        ordinal = self.base + len(self.positions)
+        timestamp = timestamp_of(event.timestamp)
+        if not self.by_time or timestamp >= self.by_time[-1]:
+            self.by_time.append(timestamp)
+            self.by_time_ordinals.append(ordinal)
+        else:
+            # late, usually by little: the insertion only moves the entries after it
+            i = bisect.bisect_right(self.by_time, timestamp)
+            self.by_time.insert(i, timestamp)
+            self.by_time_ordinals.insert(i, ordinal)
+        level = LEVEL_CODES.get(event.level, 255)
+        cid = -1
+        if event.cid is not None:
+            cid = self.cid_ids.setdefault(str(event.cid), len(self.cid_ids))
+            self.by_cid.setdefault(cid, array('Q')).append(ordinal)
+        self.by_level.setdefault(level, array('Q')).append(ordinal)
+        self.positions.append(position)
+        self.timestamps.append(timestamp)
+        self.levels.append(level)
+        self.cids.append(cid)
+        if len(self.positions) > self.max_reports + self.max_reports // 4:
+            self._trim(len(self.positions) - self.max_reports)
+
+    def _trim(self, count: int):
+        """
+        Forget the oldest ``count`` reports, in batches of a quarter of ``max_reports`` so it stays amortized
+        """
+        self.base += count
+        del self.positions[:count], self.timestamps[:count], self.levels[:count], self.cids[:count]
+        for postings in itertools.chain(self.by_level.values(), self.by_cid.values()):
+            del postings[:bisect.bisect_left(postings, self.base)]
+        unused = {cid for cid, postings in self.by_cid.items() if not postings}
+        if unused:
+            self.cid_ids = {key: cid for key, cid in self.cid_ids.items() if cid not in unused}
+            for cid in unused:
+                del self.by_cid[cid]
+        kept = [i for i, ordinal in enumerate(self.by_time_ordinals) if ordinal >= self.base]
+        self.by_time = array('d', (self.by_time[i] for i in kept))
+        self.by_time_ordinals = array('Q', (self.by_time_ordinals[i] for i in kept))
+
+    def query(self, type: str = UpEventType.report, level: Optional[ReportLevel] = None, cid: Optional[str] = None,
+              since: Optional[float] = None, until: Optional[float] = None,
+              limit: int = 50, cursor: Optional[int] = None) -> tuple[list[int], Optional[int]]:
+        """
+        Find events, newest first
+        :param cursor: the cursor returned by the previous page, None for the first page
+        :return: event positions and the cursor of the next page (None when exhausted)
+        """
+        if type != UpEventType.report:
+            postings = self.types.get(str(type), array('Q'))
+            # the cursor is the position of the last event returned, the postings may have been trimmed since
+            end = len(postings) if cursor is None else bisect.bisect_left(postings, cursor)
+            start = max(0, end - limit)
+            return [postings[i] for i in range(end - 1, start - 1, -1)], postings[start] if start else None
+
+        level_code = None if level is None else LEVEL_CODES.get(level, 255)
+        cid_id = None
+        if cid is not None:
+            cid_id = self.cid_ids.get(str(cid))
+            if cid_id is None:
+                return [], None
+
+        # the ordinal range allowed by the cursor
+        base = self.base
+        low, high = base, base + len(self.positions)
+        if cursor is not None:
+            high = min(high, cursor)
+
+        candidates = None
+        for postings in (
+                None if level_code is None else self.by_level.get(level_code, array('Q')),
+                None if cid_id is None else self.by_cid.get(cid_id, array('Q'))
+        ):
+            if postings is not None and (candidates is None or len(postings) < len(candidates)):
+                candidates = postings
+
+        if since is not None or until is not None:
+            begin = 0 if since is None else bisect.bisect_left(self.by_time, since)
+            stop = len(self.by_time) if until is None else bisect.bisect_right(self.by_time, until)
+            if stop - begin < (high - low if candidates is None else len(candidates)):
+                # the time range is the most selective, its ordinals are sorted back to newest first
+                candidates = array('Q', sorted(
+                    ordinal for ordinal in self.by_time_ordinals[begin:stop] if low <= ordinal < high
+                ))
+
+        if candidates is None:
+            ordinals = range(high - 1, low - 1, -1)
+        else:
+            begin, stop = bisect.bisect_left(candidates, low), bisect.bisect_left(candidates, high)
+            ordinals = (candidates[i] for i in range(stop - 1, begin - 1, -1))
+
+        found = []
+        for ordinal in ordinals:
+            if len(found) == limit:
+                return [self.positions[o - base] for o in found], found[-1]
+            i = ordinal - base
+            if level_code is not None and self.levels[i] != level_code:
+                continue
+            if cid_id is not None and self.cids[i] != cid_id:
+                continue
+            timestamp = self.timestamps[i]
+            if (since is not None and timestamp < since) or (until is not None and timestamp > until):
+                continue
+            found.append(ordinal)
+        return [self.positions[o - base] for o in found], None
+
+    def copy(self) -> "ReportIndex":
+        """
+        A copy that does not change with this index, the arrays are copied with memcpy
+        """
+        clone = object.__new__(ReportIndex)
+        for key, value in self.__dict__.items():
+            if isinstance(value, dict):
+                value = {k: v[:] if isinstance(v, array) else v for k, v in value.items()}
+            elif isinstance(value, (array, bytearray)):
+                value = value[:]
+            clone.__dict__[key] = value
+        return clone
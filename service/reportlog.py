@@ -0,0 +1,232 @@
+import asyncio
+import os
+import pathlib
+import time
+import uuid
+from json import JSONDecodeError
+from typing import IO, Iterator, Optional, Self
+
+from quart import json
+
+from log import logger
+
+
+class ReportLog:
+    """
+    Append-only report log of one plugin, stored as size-rotated JSON-lines segments
+
+    Records are buffered in memory and encoded/written by a worker thread, so appending never blocks the loop.
+    The JSON array written by FileReportHandler before, if any, is imported as the first segment when the log is
+    first written, the segments written before it are shifted.
+    """
+    base_path = pathlib.Path('./report_logs')
+    legacy_path = pathlib.Path('.')  # where FileReportHandler wrote <sid>_report.json
+    segment_suffix = '.jsonl'
+    max_segment_size = 16 * 1024 * 1024  # bytes, a new segment is started once exceeded
+    flush_interval = 0.2  # seconds, the longest a record stays in the buffer
+    flush_records = 256  # flush at once when that many records are buffered
+    fsync_records = 1024  # fsync after N records...
+    fsync_interval = 1000  # ...or T milliseconds after the first unsynced write
+    logs: dict[uuid.UUID, Self] = {}
+
+    def __init__(self, sid: uuid.UUID):
+        self.sid = sid
+        self.path = self.base_path / str(sid)
+        self._buffer: list[dict] = []
+        self._lock = asyncio.Lock()
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._sync_handle: Optional[asyncio.TimerHandle] = None
+        self._flushing: Optional[asyncio.Task] = None
+        self._fp: Optional[IO[bytes]] = None
+        self._segment_index = -1
+        self._unsynced = 0
+        self._unsynced_since = 0.0
+        self._legacy_checked = False
+
+    @classmethod
+    def of(cls, sid: uuid.UUID) -> Self:
+        log = cls.logs.get(sid)
+        if log is None:
+            log = cls.logs[sid] = cls(sid)
+        return log
+
+    @classmethod
+    async def close_all(cls):
+        for log in list(cls.logs.values()):
+            await log.close()
+
+    def append(self, record: dict):
+        self._buffer.append(record)
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if len(self._buffer) >= self.flush_records:
+            self._start_flush()
+        elif self._flush_handle is None and self._flushing is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.flush_interval, self._start_flush)
+
+    def _start_flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._flushing is None:
+            self._flushing = asyncio.create_task(self.flush())
+            self._flushing.add_done_callback(self._flushed)
+
+    def _flushed(self, task: asyncio.Task):
+        self._flushing = None
+        if not task.cancelled() and task.exception() is not None:
+            logger.opt(exception=task.exception()).error("Failed to write report log of {sid}", sid=self.sid)
+        if self._buffer:
+            self._schedule_flush()
+        if self._unsynced and self._sync_handle is None:
+            self._sync_handle = asyncio.get_running_loop().call_later(self.fsync_interval / 1000, self._start_sync)
+
+    def _start_sync(self):
+        self._sync_handle = None
+        asyncio.create_task(self.sync())
+
+    async def flush(self):
+        async with self._lock:
+            if not self._buffer:
+                return
+            records, self._buffer = self._buffer, []
+            await asyncio.to_thread(self._write, records)
+
+    async def sync(self):
+        async with self._lock:
+            await asyncio.to_thread(self._fsync)
+
+    async def close(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._sync_handle is not None:
+            self._sync_handle.cancel()
+            self._sync_handle = None
+        await self.flush()
+        async with self._lock:
+            await asyncio.to_thread(self._close_segment)
+
+    def segments(self) -> list[pathlib.Path]:
+        if not self.path.is_dir():
+            return []
+        return sorted(self.path.glob(f'*{self.segment_suffix}'))
+
+    @property
+    def legacy_file(self) -> pathlib.Path:
+        return self.legacy_path / f'{self.sid}_report.json'
+
+    def iter_records(self) -> Iterator[dict]:
+        """
+        Read the records written so far, the buffered ones are not. A record cut short by a crash is skipped.
+        """
+        legacy = self.legacy_file
+        if legacy.is_file():
+            # not imported yet
+            with legacy.open('r', encoding='u8') as fp:
+                yield from json.load(fp)
+        for segment in self.segments():
+            with segment.open('r', encoding='u8') as fp:
+                for lineno, line in enumerate(fp, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        yield json.loads(line)
+                    except JSONDecodeError:
+                        logger.warning("Skip broken report record {path}:{lineno}", path=segment, lineno=lineno)
+
+    # The methods below run in the worker thread, serialized by ``self._lock``
+
+    def _import_legacy(self):
+        """
+        Write the reports of the legacy ``<sid>_report.json`` as segment 0, after the existing ones are shifted
+        """
+        if self._legacy_checked:
+            return
+        self._legacy_checked = True
+        legacy = self.legacy_file
+        if not legacy.is_file():
+            return
+        try:
+            with legacy.open('r', encoding='u8') as fp:
+                records = json.load(fp)
+        except (OSError, ValueError) as e:
+            logger.error("Cannot import the reports of {sid} from {path}: {e}", sid=self.sid, path=legacy, e=e)
+            return
+        segment = self.path / f'{0:08d}{self.segment_suffix}'
+        tmp_path = segment.with_name(f'{segment.name}.tmp')
+        with tmp_path.open('wb') as fp:
+            fp.write(''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records).encode('u8'))
+            fp.flush()
+            os.fsync(fp.fileno())
+        # the last one first, so the segments stay in order if this is interrupted
+        for path in reversed(self.segments()):
+            path.rename(self.path / f'{int(path.stem) + 1:08d}{self.segment_suffix}')
+        os.replace(tmp_path, segment)
+        legacy.rename(legacy.with_name(f'{legacy.name}.imported'))  # kept, but not imported again
+        logger.info("Imported {count} reports of {sid} from {path}", count=len(records), sid=self.sid, path=legacy)
+
+    def _write(self, records: list[dict]):
+        data = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records).encode('u8')
+        fp = self._open_segment()
+        fp.write(data)
+        fp.flush()
+        if not self._unsynced:
+            self._unsynced_since = time.monotonic()
+        self._unsynced += len(records)
+        if self._unsynced >= self.fsync_records \
+                or (time.monotonic() - self._unsynced_since) * 1000 >= self.fsync_interval:
+            self._fsync()
+        if fp.tell() >= self.max_segment_size:
+            self._close_segment()
+            self._segment_index += 1
+
+    def _open_segment(self) -> IO[bytes]:
+        if self._fp is not None:
+            return self._fp
+        if self._segment_index < 0:
+            self.path.mkdir(parents=True, exist_ok=True)
+            self._import_legacy()
+            segments = self.segments()
+            self._segment_index = int(segments[-1].stem) if segments else 0
+        segment = self.path / f'{self._segment_index:08d}{self.segment_suffix}'
+        if segment.is_file() and segment.stat().st_size >= self.max_segment_size:
+            self._segment_index += 1
+            segment = self.path / f'{self._segment_index:08d}{self.segment_suffix}'
+        self._fp = segment.open('ab')
+        self._truncate_torn_record()
+        return self._fp
+
+    def _truncate_torn_record(self):
+        """
+        Cut a record left incomplete by a crash, the next one would be appended to it
+        """
+        size = self._fp.seek(0, os.SEEK_END)
+        if not size:
+            return
+        with open(self._fp.name, 'rb') as fp:
+            position = size
+            while position:
+                start = max(0, position - 64 * 1024)
+                fp.seek(start)
+                block = fp.read(position - start)
+                newline = block.rfind(b'\n')
+                if newline >= 0:
+                    position = start + newline + 1
+                    break
+                position = start
+        if position < size:
+            logger.warning("Cut the torn last record of {path}", path=self._fp.name)
+            self._fp.truncate(position)
+
+    def _fsync(self):
+        if self._fp is not None and self._unsynced:
+            os.fsync(self._fp.fileno())
+        self._unsynced = 0
+
+    def _close_segment(self):
+        if self._fp is not None:
+            self._fsync()
+            self._fp.close()
+            self._fp = None
@@ -7,6 +7,8 @@ from typing import TypedDict, Optional, Literal
 
 from strongtyping.strong_typing import match_class_typing
 
+from .codecs import CODECS
+
 StrSetArrayType = list[str] | tuple[str] | set[str]
 
 
@@ -22,6 +24,13 @@ class PackageInfo(TypedDict, total=False):
     peerDependencies: StrSetArrayType
 
 
+class OverflowPolicy(enum.StrEnum):
+    drop_oldest = 'drop_oldest'
+    drop_newest = 'drop_newest'
+    coalesce = 'coalesce'  # a new event replaces the queued ones of the same type
+    disconnect = 'disconnect'  # the slow consumer gets disconnected
+
+
 @dataclass
 class PluginInfo:
     sid: Optional[uuid.UUID | str] = None
@@ -38,10 +47,22 @@ class ClientInfo(PluginInfo):
     _ = KW_ONLY
     description: Optional[str] = ''
     packageInfo: Optional[PackageInfo] = field(default_factory=PackageInfo)
+    overflow: Optional[OverflowPolicy] = None
+    batchAck: bool = False  # acknowledge every batch frame, and every rejected event, with an AckEvent
+    encoding: str = 'json'  # one of service.codecs.CODECS, the greeting is always JSON
+    heartbeat: bool = False  # the client answers pings, it is evicted when it stops answering
+    cid: Optional[uuid.UUID] = None  # of the previous connection, to resume it
+    lastSeq: Optional[int] = None  # last sequence number received by the previous connection
 
     def __post_init__(self):
         if not isinstance(self.sid, uuid.UUID) and self.sid is not None:
             self.sid = uuid.UUID(self.sid)
+        if not isinstance(self.cid, uuid.UUID) and self.cid is not None:
+            self.cid = uuid.UUID(self.cid)
+        if self.overflow is not None:
+            self.overflow = OverflowPolicy(self.overflow)
+        if self.encoding not in CODECS:
+            raise ValueError(f'Unsupported encoding {self.encoding}, expected one of {", ".join(CODECS)}')
 
 
 class GeneralEventType(enum.StrEnum):
@@ -61,6 +82,7 @@ class UpEventType(enum.StrEnum):
     required = 'required'
     fetch = 'fetch'
     report = 'report'
+    pong = 'pong'  # answers a ping, never dispatched to the plugin
 
 
 class DownEventType(enum.StrEnum):
@@ -74,6 +96,8 @@ class DownEventType(enum.StrEnum):
     alert = 'alert'
     hmr = 'hmr'  # may not be able to use because of the koishi policy
     execute = 'execute'  # may not be able to use because of the koishi policy
+    ack = 'ack'
+    ping = 'ping'
 
 
 class SpecialEventType(enum.StrEnum):
@@ -109,6 +133,8 @@ class UpEvent(BaseEvent):
 @dataclass
 class DownEvent(BaseEvent):
     type: DownEventType | GeneralEventType
+    _: KW_ONLY
+    seq: Optional[int] = None  # position in the replay log of the plugin, for the events sent to all its clients
 
 
 @dataclass
@@ -154,6 +180,36 @@ class BroadcastEvent(DownEvent):
         self.type = DownEventType.broadcast
 
 
+@dataclass
+class AckEvent(DownEvent):
+    """
+    Ack Event: result of a batch frame, or of a single event frame that was rejected
+    :var count: events in the batch
+    :var accepted: events dispatched to the plugin
+    :var errors: {"index": position in the batch, "message": why it was rejected} of the other ones
+    """
+    type: Literal[DownEventType.ack] = field(init=False)
+    count: int
+    accepted: int
+    errors: list[dict] = field(default_factory=list)
+
+    def __post_init__(self):
+        self.type = DownEventType.ack
+
+
+@dataclass
+class PingEvent(DownEvent):
+    """
+    Ping Event: sent to idle clients, answered by {"type": "pong"}
+    :var timestamp: server time of the ping
+    """
+    type: Literal[DownEventType.ping] = field(init=False)
+    timestamp: float
+
+    def __post_init__(self):
+        self.type = DownEventType.ping
+
+
 @dataclass
 class DataEvent(BaseEvent):
     """
@@ -181,8 +237,8 @@ class ReportEvent(UpEvent):
     sid: uuid.UUID
     type: Literal[UpEventType.report] = field(init=False)
     level: ReportLevel
-    description: str
-    timestamp: int | float | datetime.datetime = datetime.datetime.utcnow()
+    description: Optional[str]
+    timestamp: int | float | datetime.datetime = field(default_factory=lambda: datetime.datetime.now(datetime.UTC))
     cid: Optional[uuid.UUID] = None
     info: Optional[str] = None
     error: Optional[JavascriptError] = None
@@ -204,6 +260,8 @@ event_mapping = {
 
 class Handler(ABC):
     type = 'default'
+    inline = False  # emit_batch never suspends, it is awaited in place instead of in a task of its own
+    timeout: Optional[float] = 10.0  # seconds an emit_batch may take, for handlers that are not inline
 
     @abstractmethod
     async def emit(self, plugin, event: UpEvent):
@@ -214,6 +272,15 @@ class Handler(ABC):
         """
         pass
 
+    async def emit_batch(self, plugin, events: list[UpEvent]):
+        """
+        Handle the events of one dispatch, in order. Override it when a batch costs less than its events.
+        :param events: Events matching this handler
+        :type plugin: service.manager.PluginService
+        """
+        for event in events:
+            await self.emit(plugin, event)
+
 
 class ReportHandler(Handler, ABC):
     type = UpEventType.report
@@ -0,0 +1,309 @@
+import dataclasses
+import datetime
+import enum
+import types
+import typing
+import uuid
+from typing import Any, Callable, Literal, Optional, Union, is_typeddict
+
+from strongtyping.strong_typing import MatchTypedDict
+
+Converter = Callable[[Any], Any]
+
+
+class ValidationError(ValueError):
+    """
+    A payload not matching its class, ``path`` is where, from the outermost key
+    """
+
+    def __init__(self, message: str):
+        super().__init__(message)
+        self.message = message
+        self.path: list[str] = []
+
+    def __str__(self):
+        if not self.path:
+            return f'Payload {self.message}'
+        return f"'{'.'.join(self.path)}' {self.message}"
+
+
+_validators: dict[type, Callable[[dict], Any]] = {}
+
+
+def validator(cls: type) -> Callable[[dict], Any]:
+    """
+    The validator of a dataclass or TypedDict, compiled on first use
+
+    It takes the JSON-decoded payload and returns the instance, with the values converted the way the class
+    expects them: enums from their values, UUIDs from strings, datetimes from timestamps, nested TypedDicts and
+    dataclasses validated in turn. Unknown keys are rejected like the dataclass constructor does, an ``Optional``
+    field without a default may be left out.
+    :raise ValidationError: the payload does not match, the message names the offending key
+    """
+    cls = _unwrap(cls)
+    validate_class = _validators.get(cls)
+    if validate_class is None:
+        validate_class = _validators[cls] = _compile_class(cls)
+    return validate_class
+
+
+def validate(cls: type, data: dict) -> Any:
+    return validator(cls)(data)
+
+
+def _compile_class(cls: type) -> Callable[[dict], Any]:
+    """
+    Generate the source of the validator, one straight block per key, like dataclasses does for __init__
+    """
+    hints = typing.get_type_hints(cls)
+    if is_typeddict(cls):
+        # (key, annotation, has a default)
+        keys = [(name, hint, name not in cls.__required_keys__) for name, hint in hints.items()]
+    elif dataclasses.is_dataclass(cls):
+        missing = dataclasses.MISSING
+        keys = [
+            (f.name, hints[f.name], f.default is not missing or f.default_factory is not missing)
+            for f in dataclasses.fields(cls) if f.init
+        ]
+    else:
+        raise TypeError(f'Cannot compile a validator of {cls}')
+
+    namespace = {
+        'ValidationError': ValidationError,
+        'known': frozenset(name for name, *_ in keys),
+        'factory': dict if is_typeddict(cls) else cls,
+    }
+    lines = [
+        'def validate_class(data):',
+        '    if not isinstance(data, dict):',
+        '        raise ValidationError("must be an object")',
+        '    if not known.issuperset(data):',
+        '        unknown = ", ".join(sorted(map(str, set(data) - known)))',
+        '        raise ValidationError(f"has unknown keys: {unknown}")',
+        '    values = {}',
+        '    key = None',
+        '    try:',
+    ]
+    for index, (name, hint, has_default) in enumerate(keys):
+        lines += [f'        key = {name!r}', '        if key in data:']
+        checked = _plain_type(hint)
+        if checked is None:
+            namespace[f'convert_{index}'] = _compile(hint)
+            lines.append(f'            values[key] = convert_{index}(data[key])')
+        else:
+            # a bare isinstance check is inlined, it is most of the keys
+            namespace[f'type_{index}'] = checked
+            test = f'not isinstance(value, type_{index})'
+            lines += [
+                '            value = data[key]',
+                f'            if {"value is not None and " if _optional(hint) else ""}{test}:',
+                f'                raise ValidationError("must be {checked.__name__}")',
+                '            values[key] = value',
+            ]
+        if has_default:
+            continue  # the constructor fills it in, a TypedDict leaves it out
+        if _optional(hint):
+            lines += ['        else:', '            values[key] = None']
+        else:
+            lines += ['        else:', '            raise ValidationError("is missing")']
+    lines += [
+        '    except ValidationError as e:',
+        '        e.path.insert(0, key)',
+        '        raise',
+        '    try:',
+        '        return factory(**values)',
+        '    except (TypeError, ValueError) as e:',
+        '        raise ValidationError(f"is invalid: {e}") from e',
+    ]
+    exec('\n'.join(lines), namespace)
+    return namespace['validate_class']
+
+
+def _plain_type(hint) -> Optional[type]:
+    """
+    The class of an annotation, or an Optional one, that is validated by isinstance alone
+    """
+    if _is_union(hint):
+        args = [arg for arg in typing.get_args(hint) if arg is not type(None)]
+        if len(args) != 1:
+            return None
+        hint = args[0]
+    hint = _unwrap(hint)
+    return hint if _is_plain_class(hint) else None
+
+
+def _is_plain_class(hint) -> bool:
+    return (
+        isinstance(hint, type) and typing.get_origin(hint) is None
+        and hint not in (object, bool, int, float, uuid.UUID, datetime.datetime, list, tuple, set, dict)
+        and not issubclass(hint, enum.Enum) and not is_typeddict(hint) and not dataclasses.is_dataclass(hint)
+    )
+
+
+def _unwrap(hint):
+    # the TypedDicts checked by strongtyping's match_class_typing are wrapped
+    return hint.cls if isinstance(hint, MatchTypedDict) else hint
+
+
+def _optional(hint) -> bool:
+    return type(None) in typing.get_args(hint) if _is_union(hint) else hint is type(None)
+
+
+def _is_union(hint) -> bool:
+    return typing.get_origin(hint) in (Union, types.UnionType)
+
+
+def _compile(hint) -> Converter:
+    """
+    The converter of one annotation
+    """
+    hint = _unwrap(hint)
+    if hint is Any or hint is object:
+        return _identity
+    if hint is type(None):
+        return _check(lambda value: value is None, 'null')
+    origin = typing.get_origin(hint)
+    if _is_union(hint):
+        return _compile_union(typing.get_args(hint))
+    if origin is Literal:
+        allowed = typing.get_args(hint)
+        return _check(lambda value: value in allowed, ' or '.join(map(repr, allowed)))
+    if origin in (list, tuple, set):
+        args = typing.get_args(hint)
+        return _compile_sequence(origin, _compile(args[0]) if args else _identity)
+    if origin is dict or hint is dict:
+        return _check(lambda value: isinstance(value, dict), 'an object')
+    if hint in (list, tuple, set):
+        return _compile_sequence(hint, _identity)
+    if is_typeddict(hint) or dataclasses.is_dataclass(hint):
+        return _nested(hint)
+    if isinstance(hint, type):
+        if issubclass(hint, enum.Enum):
+            return _compile_enum(hint)
+        if hint is bool:
+            return _check(lambda value: value is True or value is False, 'a boolean')
+        if hint is int:
+            return _check(lambda value: isinstance(value, int) and value is not True and value is not False,
+                          'an integer')
+        if hint is float:
+            return _check(lambda value: isinstance(value, (int, float)) and not isinstance(value, bool), 'a number')
+        if hint is uuid.UUID:
+            return _convert_uuid
+        if hint is datetime.datetime:
+            return _convert_datetime
+        return _compile_instance(hint)
+    return _identity
+
+
+def _identity(value):
+    return value
+
+
+def _check(predicate: Callable[[Any], bool], expected: str) -> Converter:
+    def check(value):
+        if not predicate(value):
+            raise ValidationError(f'must be {expected}')
+        return value
+
+    return check
+
+
+def _compile_instance(hint: type) -> Converter:
+    def check_instance(value):
+        if not isinstance(value, hint):
+            raise ValidationError(f'must be {hint.__name__}')
+        return value
+
+    return check_instance
+
+
+def _compile_union(args: tuple) -> Converter:
+    nullable = type(None) in args
+    converters = tuple(_compile(arg) for arg in args if arg is not type(None))
+    if len(converters) == 1:
+        convert = converters[0]
+
+        def convert_optional(value):
+            return None if value is None else convert(value)
+
+        return convert_optional if nullable else convert
+
+    def convert_union(value):
+        if value is None and nullable:
+            return None
+        for convert in converters:
+            try:
+                return convert(value)
+            except ValidationError:
+                pass
+        raise ValidationError('does not match any of its types')
+
+    return convert_union
+
+
+def _compile_sequence(origin: type, item: Converter) -> Converter:
+    def convert_sequence(value):
+        if not isinstance(value, (list, tuple)):
+            raise ValidationError('must be an array')
+        if item is _identity:
+            return origin(value)
+        converted = []
+        for index, v in enumerate(value):
+            try:
+                converted.append(item(v))
+            except ValidationError as e:
+                e.path.insert(0, str(index))
+                raise
+        return origin(converted)
+
+    return convert_sequence
+
+
+def _compile_enum(hint: type[enum.Enum]) -> Converter:
+    members = hint._value2member_map_
+    expected = ', '.join(map(str, members))
+
+    def convert_enum(value):
+        if isinstance(value, hint):
+            return value
+        try:
+            member = members.get(value)
+        except TypeError:  # unhashable
+            member = None
+        if member is None:
+            raise ValidationError(f'must be one of {expected}')
+        return member
+
+    return convert_enum
+
+
+def _nested(hint: type) -> Converter:
+    compiled: Optional[Callable] = None
+
+    def convert_nested(value):
+        nonlocal compiled
+        if compiled is None:  # compiled lazily, the class may refer to itself
+            compiled = validator(hint)
+        return compiled(value)
+
+    return convert_nested
+
+
+def _convert_uuid(value):
+    if isinstance(value, uuid.UUID):
+        return value
+    try:
+        return uuid.UUID(value)
+    except (TypeError, ValueError, AttributeError):
+        raise ValidationError('must be a UUID')
+
+
+def _convert_datetime(value):
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        try:
+            return datetime.datetime.fromtimestamp(value, tz=datetime.UTC)
+        except (OverflowError, OSError, ValueError):
+            pass
+    raise ValidationError('must be a timestamp')
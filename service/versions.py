@@ -0,0 +1,51 @@
+import operator
+import re
+from typing import Callable, Optional
+
+OPERATORS: dict[str, Callable[[tuple, tuple], bool]] = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<=': operator.le,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '>': operator.gt,
+}
+PREDICATE_PATTERN = re.compile(r'\s*(==|!=|<=|>=|<|>|=)?\s*([0-9A-Za-z][0-9A-Za-z.+-]*)\s*')
+
+
+def version_key(version: str) -> tuple:
+    """
+    Sort key of a semver-like version: numeric parts compared as numbers, pre-releases before their release
+    """
+    main, _, pre = version.partition('+')[0].partition('-')
+    numbers = [int(part) if part.isdigit() else 0 for part in main.lstrip('vV').split('.')]
+    while numbers and numbers[-1] == 0:
+        numbers.pop()
+    return tuple(numbers), (1,) if not pre else (0, pre)
+
+
+class VersionPredicate:
+    """
+    A version or a comparison with one, like ``1.2.3``, ``<1.4`` or ``!=2.0.0-beta``, several joined by ``,``
+    all have to match. Clients without a version never match.
+    """
+    __slots__ = ('text', 'clauses')
+
+    def __init__(self, text: str):
+        self.text = text
+        self.clauses: list[tuple[Callable[[tuple, tuple], bool], tuple]] = []
+        for clause in text.split(','):
+            match = PREDICATE_PATTERN.fullmatch(clause)
+            if match is None:
+                raise ValueError(f'Invalid version predicate {text!r}')
+            op, version = match.groups()
+            self.clauses.append((OPERATORS.get(op or '==', operator.eq), version_key(version)))
+
+    def __call__(self, version: Optional[str]) -> bool:
+        if version is None:
+            return False
+        key = version_key(version)
+        return all(op(key, expected) for op, expected in self.clauses)
+
+    def __repr__(self):
+        return f"<VersionPredicate {self.text}>"
@@ -0,0 +1,213 @@
+import asyncio
+import contextlib
+import pathlib
+import pickle
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Optional, TypeVar
+
+from log import logger
+
+T = TypeVar('T')
+EVENT_COLUMNS = {'type': 'TEXT', 'level': 'TEXT', 'cid': 'TEXT', 'timestamp': 'REAL'}
+INSERT_EVENT = 'INSERT INTO events (sid, type, level, cid, timestamp, value) VALUES (?, ?, ?, ?, ?, ?)'
+
+
+def encode(obj: Any) -> bytes:
+    return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+
+def decode(data: bytes) -> Any:
+    return pickle.loads(data)
+
+
+class SqliteStorage:
+    """
+    Keyed collections and an append-only event table in one sqlite database in WAL mode
+
+    Several worker processes can share the database: WAL lets readers run alongside the single writer, and a
+    writer waits up to ``busy_timeout`` for the lock of another process instead of failing. Every thread gets
+    its own connection, the async API runs the calls on a small thread pool so the loop never waits on disk.
+    Values are pickled by the caller with ``encode``, on the loop, so objects are never read from two threads.
+
+    The events are stored with the columns they are queried by (type, level, cid and timestamp), the table is
+    the whole, paged, event history shared by the workers.
+    """
+    path = pathlib.Path('./data/storage.db')
+    busy_timeout = 5000  # milliseconds
+    threads = 2
+
+    def __init__(self, path: pathlib.Path = None):
+        if path is not None:
+            self.path = path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.executor = ThreadPoolExecutor(self.threads, thread_name_prefix='storage')
+        self._local = threading.local()
+        self._tables: set[str] = set()
+        self._connections: list[sqlite3.Connection] = []
+        connection = self.connection()
+        connection.execute('PRAGMA journal_mode=WAL')  # persistent, set once for every process
+        with self._transaction(connection):
+            connection.execute('CREATE TABLE IF NOT EXISTS events '
+                               '(id INTEGER PRIMARY KEY AUTOINCREMENT, sid TEXT NOT NULL, value BLOB NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS events_sid ON events (sid, id)')
+            columns = {name for _, name, *_ in connection.execute('PRAGMA table_info(events)')}
+            for column, column_type in EVENT_COLUMNS.items():
+                if column not in columns:
+                    # the rows written before are filled in by backfill_events
+                    connection.execute(f'ALTER TABLE events ADD COLUMN {column} {column_type}')
+            connection.execute('CREATE INDEX IF NOT EXISTS events_type ON events (sid, type, id)')
+            connection.execute('CREATE INDEX IF NOT EXISTS events_cid ON events (sid, cid, id)')
+            connection.execute('CREATE TABLE IF NOT EXISTS sequences (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+
+    def connection(self) -> sqlite3.Connection:
+        connection: Optional[sqlite3.Connection] = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout / 1000, isolation_level=None,
+                                         check_same_thread=False)  # only for close()
+            connection.execute('PRAGMA synchronous=NORMAL')  # durable at checkpoints, enough with WAL
+            connection.execute(f'PRAGMA busy_timeout={self.busy_timeout}')
+            self._local.connection = connection
+            self._connections.append(connection)
+        return connection
+
+    def _table(self, connection: sqlite3.Connection, collection: str) -> str:
+        if not collection.isidentifier():
+            raise ValueError(f'Invalid collection name {collection!r}')
+        if collection not in self._tables:
+            connection.execute(f'CREATE TABLE IF NOT EXISTS "{collection}" '
+                               f'(key TEXT PRIMARY KEY, value BLOB NOT NULL)')
+            self._tables.add(collection)
+        return collection
+
+    async def run(self, func: Callable[..., T], *args) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def load(self, collection: str, prefix: str = '') -> dict[str, Any]:
+        """
+        :param prefix: only the rows of the keys starting with it
+        """
+        connection = self.connection()
+        table = self._table(connection, collection)
+        return {key: decode(value) for key, value in connection.execute(
+            f'SELECT key, value FROM "{table}" WHERE substr(key, 1, ?) = ?', (len(prefix), prefix)
+        )}
+
+    def write(self, collection: str, items: dict[str, bytes], deleted: Iterable[str] = ()):
+        """
+        Upsert and delete rows of a collection in one transaction
+        :param items: key: value encoded by ``encode``
+        :param deleted: keys to remove
+        """
+        connection = self.connection()
+        table = self._table(connection, collection)
+        with self._transaction(connection):
+            connection.executemany(f'INSERT OR REPLACE INTO "{table}" (key, value) VALUES (?, ?)', items.items())
+            connection.executemany(f'DELETE FROM "{table}" WHERE key = ?', ((key,) for key in deleted))
+
+    def append_events(self, events: list[tuple]):
+        """
+        :param events: (sid, type, level, cid, timestamp, event encoded by ``encode``)
+        """
+        connection = self.connection()
+        with self._transaction(connection):
+            connection.executemany(INSERT_EVENT, events)
+
+    def migrate(self, collections: dict[str, dict[str, bytes]], events: list[tuple]) -> bool:
+        """
+        Write the first rows of empty collections, and their events, in one transaction: of several workers
+        migrating at once, only the first one does
+        :param collections: collection name: key: value encoded by ``encode``
+        :param events: see ``append_events``
+        :return: False when a collection has rows already, nothing is written then
+        """
+        connection = self.connection()
+        tables = [self._table(connection, collection) for collection in collections]
+        with self._transaction(connection):
+            for table in tables:
+                if connection.execute(f'SELECT 1 FROM "{table}" LIMIT 1').fetchone() is not None:
+                    return False
+            for table, items in zip(tables, collections.values()):
+                connection.executemany(f'INSERT INTO "{table}" (key, value) VALUES (?, ?)', items.items())
+            connection.executemany(INSERT_EVENT, events)
+        return True
+
+    def backfill_events(self, columns: Callable[[Any], tuple], batch: int = 1000) -> int:
+        """
+        Fill the query columns of the events written before they existed
+        :param columns: the (type, level, cid, timestamp) of a decoded event
+        :return: the number of events filled in
+        """
+        connection = self.connection()
+        count = 0
+        while True:
+            rows = connection.execute('SELECT id, value FROM events WHERE type IS NULL LIMIT ?', (batch,)).fetchall()
+            if not rows:
+                return count
+            with self._transaction(connection):
+                connection.executemany('UPDATE events SET type = ?, level = ?, cid = ?, timestamp = ? WHERE id = ?',
+                                       ((*columns(decode(value)), row_id) for row_id, value in rows))
+            count += len(rows)
+
+    def query_events(self, sid: str, type: str, level: Optional[str] = None, cid: Optional[str] = None,
+                     since: Optional[float] = None, until: Optional[float] = None,
+                     limit: int = 50, cursor: Optional[int] = None) -> tuple[list[Any], Optional[int]]:
+        """
+        Find events of a plugin, newest first
+        :param cursor: the cursor returned by the previous page, None for the first page
+        :return: events and the cursor of the next page (None when exhausted)
+        """
+        conditions = ['sid = ?', 'type = ?']
+        params: list[Any] = [sid, type]
+        for condition, value in (('level = ?', level), ('cid = ?', cid), ('timestamp >= ?', since),
+                                 ('timestamp <= ?', until), ('id < ?', cursor)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        rows = self.connection().execute(
+            f'SELECT id, value FROM events WHERE {" AND ".join(conditions)} ORDER BY id DESC LIMIT ?',
+            (*params, limit + 1)
+        ).fetchall()
+        cursor = None
+        if len(rows) > limit:
+            del rows[limit:]
+            cursor = rows[-1][0]  # the id of the last event returned
+        return [decode(value) for _, value in rows], cursor
+
+    def next_sequence(self, key: str, at_least: int = 1) -> int:
+        """
+        Allocate the next number of a sequence shared by the workers
+        :param at_least: the lowest number to give, for a sequence that was counted elsewhere before
+        """
+        connection = self.connection()
+        with self._transaction(connection):
+            value, = connection.execute(
+                'INSERT INTO sequences (key, value) VALUES (?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET value = MAX(value + 1, excluded.value) RETURNING value',
+                (key, at_least)
+            ).fetchone()
+        return value
+
+    def sequences(self) -> dict[str, int]:
+        return dict(self.connection().execute('SELECT key, value FROM sequences'))
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _transaction(connection: sqlite3.Connection):
+        # take the write lock at once, a deferred transaction failing to upgrade its lock does not wait for it
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def close(self):
+        self.executor.shutdown()
+        for connection in self._connections:
+            connection.close()
+        self._connections.clear()
+        self._local = threading.local()
+        logger.debug("Storage {path} closed", path=self.path)
@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# the modules keep their data relative to the working directory, and some load it on import
+os.chdir(tempfile.mkdtemp(prefix='kreport-tests-'))
@@ -0,0 +1,17 @@
+import zlib
+
+import pytest
+
+from service.codecs import ZlibCodec
+
+
+def test_zlib_decode():
+    codec = ZlibCodec()
+    assert codec.decode(zlib.compress(b'{"type": "pong"}')) == {'type': 'pong'}
+
+
+def test_zlib_rejects_inflating_frame():
+    codec = ZlibCodec()
+    codec.max_size = 1024
+    with pytest.raises(codec.errors):
+        codec.decode(zlib.compress(b'[' + b' ' * 4096 + b']'))
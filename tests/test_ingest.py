@@ -0,0 +1,60 @@
+import asyncio
+import collections
+import itertools
+
+import pytest
+
+from service.ingest import IngestQueue
+from service.journal import Journal
+from service.manager import PluginService
+from service.structures import ReportEvent, ReportLevel
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    monkeypatch.setattr(IngestQueue, 'enabled', True)
+    monkeypatch.setattr(IngestQueue, 'durable', True)
+    monkeypatch.setattr(IngestQueue, 'wal', Journal(tmp_path / 'ingest.wal'))
+    monkeypatch.setattr(IngestQueue, '_items', collections.deque())
+    monkeypatch.setattr(IngestQueue, '_records', [])
+    monkeypatch.setattr(IngestQueue, '_waiters', [])
+    monkeypatch.setattr(IngestQueue, '_ids', itertools.count())
+    for name in ('_reserved', 'in_flight', 'enqueued', 'delivered'):
+        monkeypatch.setattr(IngestQueue, name, 0)
+    return IngestQueue
+
+
+def offer(queue, plugin: PluginService, count: int):
+    async def run():
+        for i in range(count):
+            assert await queue.offer(plugin, [ReportEvent(sid=plugin.sid, level=ReportLevel.info,
+                                                          description=None, info=str(i))])
+        if queue._committer is not None:
+            await queue._committer
+
+    asyncio.run(run())
+
+
+def test_undelivered_reports_are_recovered(queue):
+    plugin = PluginService.register_with_name('ingest-recovery')
+    offer(queue, plugin, 5)
+    queue._items.clear()  # the process died before delivering them
+    with queue.wal.path.open('ab') as fp:
+        fp.write(b'{"id": 5, "sid"')  # and in the middle of a write
+    queue._recover()
+    assert [item[2].info for item in queue._items] == [str(i) for i in range(5)]
+
+
+def test_delivered_reports_leave_the_log(queue):
+    plugin = PluginService.register_with_name('ingest-delivery')
+    offer(queue, plugin, 3)
+    queue._items.clear()
+
+    async def run():
+        await queue.start()
+        await asyncio.sleep(0.1)
+        await queue.stop()
+
+    asyncio.run(run())
+    assert queue.delivered == 3
+    assert list(queue.wal.replay()) == []
@@ -0,0 +1,20 @@
+from service.journal import Journal
+
+
+def test_replay_skips_torn_last_record(tmp_path):
+    journal = Journal(tmp_path / 'services.journal', fsync=True)
+    journal.extend([{'op': 'register', 'sid': '1'}, {'op': 'rename', 'sid': '1', 'name': 'a'}])
+    journal.close()
+    with journal.path.open('ab') as fp:
+        fp.write(b'{"op": "register", "si')  # a crash in the middle of an append
+
+    assert list(journal.replay()) == [{'op': 'register', 'sid': '1'}, {'op': 'rename', 'sid': '1', 'name': 'a'}]
+    assert journal.records == 2
+
+
+def test_truncate(tmp_path):
+    journal = Journal(tmp_path / 'services.journal')
+    journal.append({'op': 'register', 'sid': '1'})
+    journal.truncate()
+    assert list(journal.replay()) == []
+    assert not journal.path.exists()
@@ -0,0 +1,50 @@
+import asyncio
+import json
+import uuid
+
+import pytest
+
+from service.reportlog import ReportLog
+
+
+@pytest.fixture
+def report_log(tmp_path, monkeypatch):
+    monkeypatch.setattr(ReportLog, 'base_path', tmp_path / 'report_logs')
+    monkeypatch.setattr(ReportLog, 'legacy_path', tmp_path)
+    return ReportLog(uuid.uuid4())
+
+
+def write(log: ReportLog, records: list[dict]):
+    async def append():
+        for record in records:
+            log.append(record)
+        await log.close()
+
+    asyncio.run(append())
+
+
+def test_records_survive_a_torn_record(report_log):
+    write(report_log, [{'n': 0}, {'n': 1}])
+    segment, = report_log.segments()
+    with segment.open('ab') as fp:
+        fp.write(b'{"n": 2, "desc')  # a crash in the middle of a write
+
+    assert list(report_log.iter_records()) == [{'n': 0}, {'n': 1}]
+
+    # appended after the cut, not to the torn record
+    write(ReportLog(report_log.sid), [{'n': 3}])
+    assert list(report_log.iter_records()) == [{'n': 0}, {'n': 1}, {'n': 3}]
+
+
+def test_legacy_file_is_imported_as_segment_0(report_log):
+    write(report_log, [{'n': 'before the import'}])
+    legacy = report_log.legacy_path / f'{report_log.sid}_report.json'
+    legacy.write_text(json.dumps([{'n': 'legacy 0'}, {'n': 'legacy 1'}]))
+    # read before the import
+    assert [record['n'] for record in report_log.iter_records()] == ['legacy 0', 'legacy 1', 'before the import']
+
+    write(ReportLog(report_log.sid), [{'n': 'after the import'}])
+    assert [segment.name for segment in report_log.segments()] == ['00000000.jsonl', '00000001.jsonl']
+    assert [record['n'] for record in report_log.iter_records()] == \
+           ['legacy 0', 'legacy 1', 'before the import', 'after the import']
+    assert not legacy.exists()
@@ -0,0 +1,44 @@
+import os
+import pathlib
+import sqlite3
+import subprocess
+import sys
+import textwrap
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+SNAPSHOT = textwrap.dedent('''
+    from service.manager import PluginService
+    from service.structures import ReportEvent, ReportLevel
+
+    service = PluginService.register_with_name('migrated')
+    service.events.extend(ReportEvent(sid=service.sid, level=ReportLevel.info, description=str(i), info='i')
+                          for i in range(50))
+    PluginService.save()
+''')
+
+WORKER = textwrap.dedent('''
+    import sys
+    from service.manager import PluginService
+    from storage import SqliteStorage
+
+    PluginService.worker = sys.argv[1]
+    PluginService.primary = sys.argv[1] == '0'
+    PluginService.use_storage(SqliteStorage())
+    assert PluginService.locate(name='migrated') is not None
+''')
+
+
+def run(script: str, cwd: pathlib.Path, *args: str) -> subprocess.Popen:
+    env = dict(os.environ, PYTHONPATH=str(ROOT))
+    return subprocess.Popen([sys.executable, '-c', script, *args], cwd=cwd, env=env)
+
+
+def test_workers_migrate_the_snapshot_once(tmp_path):
+    assert run(SNAPSHOT, tmp_path).wait() == 0
+    workers = [run(WORKER, tmp_path, str(index)) for index in range(4)]
+    assert [worker.wait() for worker in workers] == [0] * 4
+
+    db = sqlite3.connect(tmp_path / 'data' / 'storage.db')
+    assert db.execute('SELECT COUNT(*), COUNT(DISTINCT value) FROM events').fetchone() == (50, 50)
+    assert db.execute('SELECT COUNT(*) FROM services').fetchone() == (1,)